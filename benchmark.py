@@ -0,0 +1,183 @@
+"""
+Benchmarks of the pipeline
+    python benchmark.py startup [calibra_path]
+    python benchmark.py extractors [out.jsonl] [sizes, e.g. 512x512,4000x3000] [repeat]
+    python benchmark.py compare old.jsonl new.jsonl [tolerance]
+"""
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+
+def synthetic_calibration(root, size=(640, 480), Tc=14):
+    """A calibration_result.npz of the form Calibrator.calibrate writes, for a camera and a
+    projector with a small relative rotation"""
+    w, h = size
+    K = np.array([[600, 0, w/2], [0, 600, h/2], [0, 0, 1.]])
+    R = cv2.Rodrigues(np.array([0, 0.02, 0.]))[0]
+    map_c1, map_c2 = cv2.initUndistortRectifyMap(K, np.zeros(5), R, K, size, cv2.CV_16SC2)
+    map_p1, map_p2 = cv2.initUndistortRectifyMap(K, np.zeros(5), R.T, K, size, cv2.CV_16SC2)
+    x = np.linspace(0, w-1, w)+np.zeros([h, w])
+    phase_rectified = cv2.remap(2*np.pi*x/Tc, map_p1, map_p2, cv2.INTER_LINEAR)
+    Q = np.array([[1, 0, 0, -w/2], [0, 1, 0, -h/2], [0, 0, 0, 600], [0, 0, 1/100, 0.]])
+    Path(root).mkdir(parents=True, exist_ok=True)
+    np.savez(Path(root)/"calibration_result", map_c1=map_c1, map_c2=map_c2, Q=Q, phase_rectified=phase_rectified)
+
+
+_startup = """
+import time
+t0 = time.perf_counter()
+from config import config
+from recons3d import Recons3D
+t1 = time.perf_counter()
+cfg = config()
+cfg.debug = False
+cfg.calibra_path = {path!r}
+cfg.calibra_artifact = {artifact!r}
+Recons3D(cfg)
+t2 = time.perf_counter()
+print(t1-t0, t2-t1)
+"""
+
+
+def run(code):
+    """The numbers that code prints, run in a fresh interpreter from the repository folder"""
+    out = subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).parent,
+                         capture_output=True, text=True, check=True).stdout
+    return [float(v) for v in out.split()]
+
+
+def startup(calibra_path=None, repeat=3):
+    """The cold start of a reconstruction worker, each in a fresh interpreter: importing
+    recons3d and constructing Recons3D, from calibration_result.npz and from the artifact"""
+    tmp = None
+    if calibra_path is None:
+        tmp = tempfile.TemporaryDirectory()
+        calibra_path = tmp.name
+        synthetic_calibration(calibra_path)
+
+    run(_startup.format(path=calibra_path, artifact="artifact"))  # build the artifact once
+    for name, artifact in (("npz", None), ("artifact", "artifact")):
+        times = np.array([run(_startup.format(path=calibra_path, artifact=artifact)) for _ in range(int(repeat))])
+        imp, con = times.min(axis=0)
+        print(f"{name:>10}: import {imp*1e3:7.1f} ms, construct {con*1e3:7.1f} ms")
+    try:
+        t, = run("import time; t = time.perf_counter(); import matplotlib.pyplot; print(time.perf_counter()-t)")
+        print(f"{'':>10}  (import matplotlib.pyplot, now deferred to debug output: {t*1e3:.1f} ms)")
+    except subprocess.CalledProcessError:
+        pass
+    if tmp is not None:
+        tmp.cleanup()
+
+
+rmse = lambda diff: float(np.sqrt(np.nanmean(diff ** 2)))
+
+
+def case_config(size, steps, periods):
+    """The config of a synthetic case, the camera sees the projector periods as in Exp1_synthesis"""
+    from config import config
+    cfg = config()
+    cfg.debug = False
+    cfg.pattern_size = tuple(size)
+    cfg.Tp = cfg.Tc = list(periods)
+    cfg.alpha = [cfg.Tp[0]/T for T in cfg.Tp]
+    cfg.A, cfg.B = [128]*len(periods), [96]*len(periods)
+    cfg.steps = [steps]*len(periods)
+    return cfg
+
+
+def extractor_case(size, steps, periods, model, methods=("PE", "MPE", "LLS", "CFPE"), repeat=3, border=20):
+    """The records of each method on the 8-bit patterns of one case: the best wall time of
+    repeat runs, the peak memory the extraction allocates and the phase RMSE (rad) against
+    generate_phase, away from the border"""
+    from fringes import fringe_wrapper, pattern_bank
+    from phase import phase_wrapper
+    cfg = case_config(size, steps, periods)
+    images = [np.array(imgs) for imgs in pattern_bank(cfg, model).images("h")]
+    truth = fringe_wrapper(cfg, model).generate_phase()[:, border:-border]
+    records = []
+    for method in methods:
+        times = []
+        for _ in range(repeat):
+            pe = phase_wrapper(cfg, method)
+            t = time.perf_counter()
+            phase, _ = pe.phase_extract(images)
+            times.append(time.perf_counter()-t)
+        del phase, pe
+        pe = phase_wrapper(cfg, method)
+        tracemalloc.start()
+        phase, _ = pe.phase_extract(images)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        diff = phase[:, border:-border]-truth
+        records.append(dict(method=method, size=list(size), steps=steps, periods=list(periods), model=model,
+                time=min(times), times=times, peak_mb=peak/2**20, rmse=rmse(diff),
+                invalid=float(np.isnan(diff).mean())))
+    return records
+
+
+def case_key(record):
+    return record["method"], tuple(record["size"]), record["steps"], tuple(record["periods"]), record["model"]
+
+
+def extractors(out="benchmark.jsonl", sizes="512x512,1024x1024,2048x2048,4000x3000", repeat=3,
+        steps=(3, 4), periods=([14, 15, 16], [33, 36, 39]), models=("gamma", "harmonic", "seg")):
+    """PE, MPE, LLS and CFPE over the grid of sizes (W x H), steps, period sets and noise models,
+    one JSON record per line in out, tagged with the commit and the machine"""
+    if isinstance(sizes, str):
+        sizes = [tuple(int(v) for v in sz.split("x")) for sz in sizes.split(",")]
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    env = dict(commit=commit, numpy=np.__version__, opencv=cv2.__version__,
+               python=platform.python_version(), machine=platform.machine(), node=platform.node())
+    with open(out, "a") as f:
+        for size, step, Ts, model in itertools.product(sizes, steps, periods, models):
+            for record in extractor_case(size, step, Ts, model, repeat=int(repeat)):
+                record.update(env)
+                f.write(json.dumps(record)+"\n")
+                f.flush()
+                print(f"{record['method']:>5} {size[0]:>5}x{size[1]:<5} {step} {str(Ts):>12} {model:>8}: "
+                      f"{record['time']*1e3:9.1f} ms, {record['peak_mb']:8.1f} MB, RMSE {record['rmse']:.4f}")
+
+
+def load_records(fn):
+    """The records of a benchmark file by case, the last run of a case wins"""
+    with open(fn) as f:
+        return {case_key(r): r for r in (json.loads(line) for line in f if line.strip())}
+
+
+def compare(old, new, tolerance=0.1):
+    """The ratios new/old of time and peak memory and the RMSE change of the cases in both files.
+    Returns the cases slower, bigger or less accurate than old by more than tolerance"""
+    old, new, tolerance = load_records(old), load_records(new), float(tolerance)
+    regressions = []
+    for key in sorted(old.keys() & new.keys()):
+        a, b = old[key], new[key]
+        t, m = b["time"]/a["time"], b["peak_mb"]/max(a["peak_mb"], 1e-9)
+        drmse = b["rmse"]-a["rmse"]
+        bad = t > 1+tolerance or m > 1+tolerance or drmse > tolerance*a["rmse"]
+        if bad:
+            regressions.append(key)
+        method, size, steps, periods, model = key
+        print(f"{method:>5} {size[0]:>5}x{size[1]:<5} {steps} {str(list(periods)):>12} {model:>8}: "
+              f"time x{t:5.2f}, memory x{m:5.2f}, RMSE {drmse:+.2e}{'  <--' if bad else ''}")
+    print(f"{len(regressions)} regressions of {len(old.keys() & new.keys())} cases")
+    return regressions
+
+
+if __name__ == '__main__':
+    benchmarks = {"startup": startup, "extractors": extractors, "compare": compare}
+    name, *args = sys.argv[1:] or ["startup"]
+    benchmarks[name](*args)
@@ -1,9 +1,14 @@
 import numpy as np
 import cv2 
 import pathlib
-import matplotlib.pyplot as plt
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
 
+from config import AttrDict
 from phase import PE
+from scans import ScanFile
+from profiler import profiler
 
 
 def reshape34(l):
@@ -12,6 +17,7 @@ def reshape34(l):
 
 
 def draw_chess(gray, points):
+    import matplotlib.pyplot as plt
     board_size = (9, 6)  # 也就是boardSize
     vis = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
     cv2.drawChessboardCorners(vis, board_size, points.reshape(-1,1,2), True)
@@ -21,9 +27,11 @@ def draw_chess(gray, points):
 
 class Calibrator():
     def __init__(self, config):
-        self._c = config
+        # a copy, the calibration recordings have their own steps
+        self._c = AttrDict(config)
         self._c.steps=[4, 4, 4]
         self.psp = PE(self._c)
+        self.scans = None
         
     def find_gray_corners(self, gray, show=False):
         board_size = (9, 6)  # 也就是boardSize
@@ -45,41 +53,114 @@ class Calibrator():
         points_c = corners.reshape(-1, 2)
         return points_w, points_c
     
+    def pose_files(self, root, i):
+        """The encoded gray image and horizontal and vertical fringe images of pose i, or with
+        cfg.calibra_scans the images themselves, views of the container"""
+        if self._c.calibra_scans:
+            if self.scans is None:
+                self.scans = ScanFile(root/self._c.calibra_scans)
+            h, v = self.scans.get(f"{i:0>2d}_", "h"), self.scans.get(f"{i:0>2d}_", "v")
+            return [h.extras[0]]+list(h.frames[:12])+list(v.frames[:12])
+        names = [f"{i:0>2d}_{12:0>2d}h.bmp"]
+        names += [f"{i:0>2d}_{j:0>2d}{hv}.bmp" for hv in "hv" for j in range(12)]
+        return [(root/name).read_bytes() for name in names]
+    
+    def read_pose(self, files):
+        """The gray image and the horizontal and vertical fringe images from pose_files()"""
+        decode = lambda f: f if isinstance(f, np.ndarray) else cv2.imdecode(np.frombuffer(f, np.uint8), 0)
+        with profiler.stage("load", nbytes=sum(np.asarray(f).nbytes for f in files)):
+            image_gray, *images = [decode(f) for f in files]
+        return image_gray, reshape34(images[:12]), reshape34(images[12:])
+    
+    def pose_key(self, files):
+        """The hash of the image files of a pose and of the config its points depend on"""
+        key = hashlib.sha1()
+        for f in files:
+            key.update(f)
+        c = self._c
+        # every setting of the extractor that changes its phases, the tiling and workers do not
+        key.update(repr((type(self.psp).__name__, c.Tc, c.steps, c.precision, c.unwrap, c.lut_bins,
+                c.MaxIter, c.tol, c.lls_solver, c.alpha, c.min_modulation, c.min_brightness,
+                c.warm_start, c.warm_check, c.warm_iter)).encode())
+        return key.hexdigest()
+    
+    def phase_extract_hv(self, pe, images_h, images_v):
+        """The horizontal and vertical sequences side by side as one batch through pe. Each is
+        padded by the halo of the extractor with its replicated edge, as the filters replicate
+        the border, so that neither sees the other"""
+        images_h, images_v = np.asarray(images_h), np.asarray(images_v)
+        W, halo = images_h.shape[-1], pe.halo
+        batch = (images_h, images_h[..., -1:].repeat(halo, -1), images_v[..., :1].repeat(halo, -1), images_v)
+        phase, T = pe.phase_extract(np.concatenate(batch, axis=-1))
+        return phase[:, :W], phase[:, W+2*halo:], T
+    
+    def process_pose(self, i):
+        """The points of pose i, from the cache if its files and config are unchanged. Returns
+        (points_w, points_c, points_p, image_gray, phase_h), the last two None when cached or
+        without cfg.debug"""
+        root = pathlib.Path(self._c.calibra_path)
+        files = self.pose_files(root, i)
+        if not self._c.calibra_cache:
+            return self.find_pose_points(i, files)
+        
+        cache = root/self._c.calibra_cache/f"{self.pose_key(files)}.npz"
+        if cache.exists():
+            with np.load(cache) as data:
+                return data["points_w"], data["points_c"], data["points_p"], None, None
+        pose = self.find_pose_points(i, files)
+        if pose is not None:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache.with_suffix(f".{os.getpid()}.{i}.tmp")
+            with open(tmp, "wb") as f:
+                np.savez(f, points_w=pose[0], points_c=pose[1], points_p=pose[2])
+            os.replace(tmp, cache)
+        return pose
+    
+    def find_pose_points(self, i, files):
+        """Find the chessboard corners of pose i and their projector points. The gray image and
+        the phase, full frames, are only kept for the debug plots"""
+        image_gray, images_h, images_v = self.read_pose(files)
+        found = self.find_gray_corners(image_gray, self._c.debug)
+        if found is None:
+            print(f"skip pose {i}")
+            return None
+        points_w, points_c = found
+        
+        # obtain the phases, every worker with its own extractor
+        phase_h, phase_v, _ = self.phase_extract_hv(type(self.psp)(self._c), images_h, images_v)
+        phase_h, phase_v = cv2.blur(phase_h,(15,15)), cv2.blur(phase_v,(15,15))# due to a plane
+
+        # phase to projector points
+        coord_h = phase_h*self._c.Tc[0]/(2*np.pi)
+        coord_v = phase_v*self._c.Tc[0]/(2*np.pi)+60
+        
+        coord_h = cv2.remap(coord_h, points_c[:,0], points_c[:,1], cv2.INTER_CUBIC)
+        coord_v = cv2.remap(coord_v, points_c[:,0], points_c[:,1], cv2.INTER_CUBIC)
+        points_p = np.concatenate((coord_h, coord_v), axis=1).astype(np.float32)
+        if not self._c.debug:
+            image_gray, phase_h = None, None
+        return points_w, points_c, points_p, image_gray, phase_h
+    
     def calibrate(self):
         root = pathlib.Path(self._c.calibra_path)
+        if self._c.debug:
+            import matplotlib.pyplot as plt
 
+        # the poses are independent up to the calibration: each worker reads a pose while
+        # the others detect corners and extract phases, OpenCV and NumPy release the GIL
+        with ThreadPoolExecutor(self._c.calibra_workers) as pool:
+            poses = list(pool.map(self.process_pose, range(self._c.calibra_poses)))
+        
         points_ws, points_cs, points_ps = [],[],[]
-        for i in range(22):
-            # read gray image and find the corners
-            name_gray = root/f"{i:0>2d}_{12:0>2d}h.bmp"
-            image_gray = cv2.imread(name_gray.as_posix(), 0)
-            points_w, points_c = self.find_gray_corners(image_gray, self._c.debug)
-            
-            # read the fringe images and obtain the phases
-            images_ph = [root/f"{i:0>2d}_{j:0>2d}h.bmp" for j in range(12)]
-            images_pv = [root/f"{i:0>2d}_{j:0>2d}v.bmp" for j in range(12)]
-            images_h = [cv2.imread(p.as_posix(), 0) for p in images_ph]
-            images_v = [cv2.imread(p.as_posix(), 0) for p in images_pv]
-            images_h = reshape34(images_h)
-            images_v = reshape34(images_v)
-
-            phase_h, T_h = self.psp.phase_extract(images_h)
-            phase_v, T_v = self.psp.phase_extract(images_v)
-            phase_h, phase_v = cv2.blur(phase_h,(15,15)), cv2.blur(phase_v,(15,15))# due to a plane
-
-            # phase to projector points
-            coord_h = phase_h*self._c.Tc[0]/(2*np.pi)
-            coord_v = phase_v*self._c.Tc[0]/(2*np.pi)+60
-            
-            coord_h = cv2.remap(coord_h, points_c[:,0], points_c[:,1], cv2.INTER_CUBIC)
-            coord_v = cv2.remap(coord_v, points_c[:,0], points_c[:,1], cv2.INTER_CUBIC)
-            points_p = np.concatenate((coord_h, coord_v), axis=1).astype(np.float32)
-            
+        for pose in poses:
+            if pose is None:
+                continue
+            points_w, points_c, points_p, image_gray, phase_h = pose
             points_ws.append(points_w)
             points_cs.append(points_c.reshape(-1,2))
             points_ps.append(points_p.reshape(-1,2))
             
-            if self._c.debug:
+            if self._c.debug and phase_h is not None:
                 plt.figure()
                 plt.subplot(1,2,1)
                 plt.imshow(phase_h)
@@ -88,7 +169,6 @@ class Calibrator():
                 plt.plot(phase_h[100,:])
                 draw_chess(image_gray, points_p.reshape(-1,2))
         
-
             
         # step 2, perform standard calibration with opencv func
         print("Calibrating the camera and projector system ...")
@@ -114,7 +194,7 @@ class Calibrator():
         map_p1, map_p2 = cv2.initUndistortRectifyMap(projetMatrix, projetDistCoeffs, R2, P2, (w_c, h_c), cv2.CV_16SC2)
         print("The valid ROIs:",validPixROI1, validPixROI2)
         
-        if self._c.debug:
+        if self._c.debug and image_gray is not None: # the last pose was not cached
             image_rgb = cv2.cvtColor(image_gray, cv2.COLOR_GRAY2BGR)
             image_rgb = cv2.drawChessboardCorners(image_rgb, (9,6), points_c.reshape(-1,1,2), True)
             proj_rgb = cv2.cvtColor(image_gray*0, cv2.COLOR_GRAY2BGR)
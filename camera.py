@@ -4,21 +4,39 @@ import numpy as np
 import sys
 import copy
 import os
-import termios
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from ctypes import *
 
-sys.path.append("/opt/MVS/Samples/64/Python/MvImport")
+libc = CDLL("libc.so.6")
 
-from MvCameraControl_class import *
 
-libc = CDLL("libc.so.6")
+def load_sdk(path="/opt/MVS/Samples/64/Python/MvImport"):
+    """The MvCameraControl_class module of the MVS SDK"""
+    sys.path.append(path)
+    import MvCameraControl_class
+    return MvCameraControl_class
+
 
+class CameraError(RuntimeError):
+    """A call of the camera SDK that failed, ret: its return code"""
+    def __init__(self, call, ret):
+        super().__init__(f"{call} failed, ret[0x{ret:x}]")
+        self.ret = ret
 
 
 class HK_Camera:
-    def __init__(self,):
+    def __init__(self, sdk=None, buffers=4):
+        """sdk: the MvCameraControl_class module, or a stand-in with the same names.
+        buffers: the frame buffers of capture_frame(), a frame stays valid for the next
+        buffers-1 captures"""
+        self.sdk = load_sdk() if sdk is None else sdk
         self.init_cam()
+        self.data_buf = (c_ubyte * self.nPayloadSize)()
+        self.pool = deque((c_ubyte * self.nPayloadSize)() for _ in range(buffers))
+        self.writer = ThreadPoolExecutor(1)
+        self.writes = []
 
     def start(self):
         # ch:开始取流 | en:Start grab image
@@ -35,36 +53,71 @@ class HK_Camera:
     #     self.exit()   
 
     def init_cam(self,):
-        deviceList = MV_CC_DEVICE_INFO_LIST()
-        tlayerType = MV_GIGE_DEVICE | MV_USB_DEVICE
-        ret = MvCamera.MV_CC_EnumDevices(tlayerType, deviceList)
+        sdk = self.sdk
+        deviceList = sdk.MV_CC_DEVICE_INFO_LIST()
+        tlayerType = sdk.MV_GIGE_DEVICE | sdk.MV_USB_DEVICE
+        ret = sdk.MvCamera.MV_CC_EnumDevices(tlayerType, deviceList)
         nConnectionNum = 0
         # ch:创建相机实例 | en:Creat Camera Object
-        self.cam = MvCamera()
+        self.cam = sdk.MvCamera()
         # ch:选择设备并创建句柄 | en:Select device and create handle
         stDeviceList = cast(deviceList.pDeviceInfo[int(nConnectionNum)], 
-                            POINTER(MV_CC_DEVICE_INFO)).contents
+                            POINTER(sdk.MV_CC_DEVICE_INFO)).contents
         ret = self.cam.MV_CC_CreateHandle(stDeviceList)        
         # ch:打开设备 | en:Open device
-        ret = self.cam.MV_CC_OpenDevice(MV_ACCESS_Exclusive, 0)
+        ret = self.cam.MV_CC_OpenDevice(sdk.MV_ACCESS_Exclusive, 0)
         # ch:设置触发模式为off | en:Set trigger mode as off
         # ret = self.cam.MV_CC_SetEnumValue("TriggerMode", MV_TRIGGER_MODE_OFF)  
 
-        ret = self.cam.MV_CC_SetEnumValue("TriggerMode", MV_TRIGGER_MODE_ON) 
-        ret = self.cam.MV_CC_SetEnumValue("TriggerSource", MV_TRIGGER_SOURCE_SOFTWARE)     
+        ret = self.cam.MV_CC_SetEnumValue("TriggerMode", sdk.MV_TRIGGER_MODE_ON) 
+        ret = self.cam.MV_CC_SetEnumValue("TriggerSource", sdk.MV_TRIGGER_SOURCE_SOFTWARE)     
 
         # ch:获取数据包大小 | en:Get payload size
-        stParam = MVCC_INTVALUE()
-        memset(byref(stParam), 0, sizeof(MVCC_INTVALUE))
+        stParam = sdk.MVCC_INTVALUE()
+        memset(byref(stParam), 0, sizeof(sdk.MVCC_INTVALUE))
 
         ret = self.cam.MV_CC_GetIntValue("PayloadSize", stParam)
         
         self.nPayloadSize = stParam.nCurValue    
 
+    def capture_frame(self, name=None):
+        """One mono8 frame as a (H, W) uint8 view of a pooled buffer, no copy, no encoding.
+        With name, the frame is also written to that file in the background. Raises
+        CameraError when the SDK returns no frame"""
+        stDeviceList = self.sdk.MV_FRAME_OUT_INFO_EX()
+        memset(byref(stDeviceList), 0, sizeof(stDeviceList))
+        self.writes = [w for w in self.writes if not w.done()]
+        while not self.pool:  # every buffer waits to be written
+            self.writes.pop(0).result()
+        buf = self.pool[0]
+        self.pool.rotate(-1)
+        
+        self.cam.MV_CC_SetCommandValue("TriggerSoftware")
+        ret = self.cam.MV_CC_GetOneFrameTimeout(byref(buf), self.nPayloadSize, stDeviceList, 1000)
+        if ret != 0:
+            raise CameraError("MV_CC_GetOneFrameTimeout", ret)
+        H, W = stDeviceList.nHeight, stDeviceList.nWidth
+        assert stDeviceList.nFrameLen == H*W, "capture_frame takes mono8 frames"
+        frame = np.frombuffer(buf, np.uint8, H*W).reshape(H, W)
+        if name is not None:
+            # the buffer is taken out of the pool until it is written
+            self.pool.remove(buf)
+            self.writes.append(self.writer.submit(self._write, name, frame, buf))
+        return frame
+    
+    def _write(self, name, frame, buf):
+        cv2.imwrite(name, frame)
+        self.pool.append(buf)
+    
+    def flush(self):
+        """Wait for the background writes"""
+        for w in self.writes:
+            w.result()
+        self.writes = []
+
     def capture_one(self, name="test"):
-        stDeviceList = MV_FRAME_OUT_INFO_EX()
+        stDeviceList = self.sdk.MV_FRAME_OUT_INFO_EX()
         memset(byref(stDeviceList), 0, sizeof(stDeviceList))
-        self.data_buf = (c_ubyte * self.nPayloadSize)()
         
         # self.cam.MV_CC_SetCommandValue("TriggerSoftware")
         # ret = self.cam.MV_CC_GetOneFrameTimeout(byref(self.data_buf), self.nPayloadSize, stDeviceList, 1000)
@@ -74,7 +127,7 @@ class HK_Camera:
         if ret == 0:
             # print ("get one frame: Width[%d], Height[%d], nFrameNum[%d]" % (stDeviceList.nWidth, stDeviceList.nHeight, stDeviceList.nFrameNum))
             nRGBSize = stDeviceList.nWidth * stDeviceList.nHeight * 3
-            stConvertParam = MV_SAVE_IMAGE_PARAM_EX()
+            stConvertParam = self.sdk.MV_SAVE_IMAGE_PARAM_EX()
             stConvertParam.nWidth = stDeviceList.nWidth
             stConvertParam.nHeight = stDeviceList.nHeight
             stConvertParam.pData = self.data_buf
@@ -83,7 +136,7 @@ class HK_Camera:
             stConvertParam.nImageLen = stConvertParam.nDataLen
             stConvertParam.nJpgQuality = 70
             # stConvertParam.enImageType = MV_Image_Jpeg
-            stConvertParam.enImageType = MV_Image_Bmp
+            stConvertParam.enImageType = self.sdk.MV_Image_Bmp
 
             stConvertParam.pImageBuffer = (c_ubyte * nRGBSize)()
             stConvertParam.nBufferSize = nRGBSize
@@ -95,16 +148,18 @@ class HK_Camera:
                 del self.data_buf
                 sys.exit()
             file_path = name
-            file_open = open(file_path.encode('ascii'), 'wb+')
             img_buff = (c_ubyte * stConvertParam.nImageLen)()
             # cdll.msvcrt.memcpy(byref(img_buff), stConvertParam.pImageBuffer, stConvertParam.nImageLen)
             memcpy = libc.memcpy(byref(img_buff), stConvertParam.pImageBuffer, stConvertParam.nImageLen)
 
-            file_open.write(img_buff)
+            with open(file_path.encode('ascii'), 'wb+') as file_open:
+                file_open.write(img_buff)
             # print(f"img write_{name}", time.time())
         # print ("Save Image succeed!")
 
     def exit(self,):
+        self.flush()
+        self.writer.shutdown()
         # ch:停止取流 | en:Stop grab image
         ret = self.cam.MV_CC_StopGrabbing()
         if ret != 0:
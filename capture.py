@@ -1,19 +1,78 @@
 import os
 import time
-from pathlib import Path 
+import queue
+import threading
+from pathlib import Path
 import numpy as np
 import cv2
 
 from config import config
-from projector import Projector
-from camera import HK_Camera
+from fringes import pattern_bank
+from profiler import profiler
+
+
+class SimProjector():
+    """A headless stand-in for Projector: the patterns of the PatternBank, for the given number of scans"""
+    def __init__(self, config, scans=1, model="fringe"):
+        self._c = config
+        self.scans = scans
+        self.shown = None
+        self.images = pattern_bank(config, model).frames
+        self.counter = dict(h=0, v=0)
+
+    def wait_to_begin(self):
+        self.scans -= 1
+        return self.scans >= 0
+
+    def update(self, hv="h"):
+        self.shown = self.images[hv][self.counter[hv]]
+        self.counter[hv] = (self.counter[hv]+1) % len(self.images[hv])
+        return self.counter[hv] != 0
+
+    def black(self):
+        pass
+
+    def exit(self):
+        pass
+
+
+class SimCamera():
+    """A headless stand-in for HK_Camera, it sees the last pattern of the projector"""
+    def __init__(self, projector, noise=0.0, seed=0):
+        self.prj = projector
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+    def start(self):
+        pass
+
+    def capture_frame(self, name=None):
+        frame = self.prj.shown
+        if self.noise:
+            frame = np.clip(frame+self.rng.normal(0, self.noise, frame.shape), 0, 255).astype(np.uint8)
+        if name is not None:
+            cv2.imwrite(name, frame)
+        return frame
+
+    def capture_one(self, name="test"):
+        self.capture_frame(name)
+
+    def exit(self):
+        pass
 
 
 class Capture():
-    def __init__(self, config):
+    def __init__(self, config, projector=None, camera=None):
+        """projector, camera: the backends, by default the pygame Projector and the HK_Camera"""
         self._c = config
-        self.prj = Projector(config)
-        self.hkc = HK_Camera()
+        if projector is None:
+            from projector import Projector
+            projector = Projector(config)
+        if camera is None:
+            from camera import HK_Camera
+            camera = HK_Camera()
+        self.prj = projector
+        self.hkc = camera
         self.hkc.start()
 
     def capture_one(self, path, hv="h"):
@@ -21,11 +80,29 @@ class Capture():
             prj_flag = True
             while prj_flag:
                 prj_flag = self.prj.update(hv)
-                time.sleep(8/24)
+                time.sleep(self._c.exposure)
                 self.prj.black()
                 self.hkc.capture_one(name=path + f"{i:0>2d}{hv}.bmp")
                 i+=1
 
+    def capture_scan(self, hv="h"):
+        """One scan in memory: the fringe images, a list (frequencies) of (steps, H, W) arrays,
+        and for "h" the gray image of the background pattern"""
+        frames = []
+        prj_flag = True
+        while prj_flag:
+            prj_flag = self.prj.update(hv)
+            time.sleep(self._c.exposure)
+            self.prj.black()
+            # a copy, the frame views of the camera are reused
+            with profiler.stage("load") as stage:
+                frames.append(np.array(self.hkc.capture_frame()))
+                stage.add(pixels=frames[-1].size, nbytes=frames[-1].nbytes)
+        cuts = np.cumsum(self._c.steps)
+        images = [np.stack(frames[a:b]) for a, b in zip(np.r_[0, cuts[:-1]], cuts)]
+        gray = frames[cuts[-1]] if len(frames) > cuts[-1] else None
+        return images, gray
+
     def calibra_capture(self):
         count = 0
         root = Path(self._c.calibra_path)
@@ -44,19 +121,78 @@ class Capture():
             self.capture_one(str(root)+ f"/{count:0>2d}", hv="h")
             count +=1
 
+    def measure_pipeline(self, process):
+        """Capture scan k+1 while process(images, gray) runs on scan k, e.g. Recons3D.measure.
+        The captured scans wait in a queue of cfg.pipeline_depth, the capture blocks when it is
+        full. Returns the results of process; self.timing keeps the seconds of each stage,
+        printed by report_timing() with cfg.debug"""
+        scans = queue.Queue(self._c.pipeline_depth)
+        stop = threading.Event()
+        self.timing = dict(capture=[], process=[], total=0.0)
+
+        def put(item):  # blocks while the queue is full, gives up once stopped
+            while not stop.is_set():
+                try:
+                    scans.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            try:
+                while not stop.is_set() and self.prj.wait_to_begin():
+                    t = time.perf_counter()
+                    scan = self.capture_scan("h")
+                    self.timing["capture"].append(time.perf_counter()-t)
+                    put(scan)
+                put(None)
+            except BaseException as e:
+                put(e)
+
+        start = time.perf_counter()
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        results = []
+        try:
+            while True:
+                scan = scans.get()
+                if scan is None:
+                    break
+                if isinstance(scan, BaseException):
+                    raise scan
+                t = time.perf_counter()
+                results.append(process(*scan))
+                self.timing["process"].append(time.perf_counter()-t)
+        finally:
+            # on an error of process the producer stops at its next capture or put
+            stop.set()
+            while not scans.empty():
+                scans.get_nowait()
+            producer.join()
+        self.timing["total"] = time.perf_counter()-start
+        if self._c.debug:
+            self.report_timing()
+        return results
+
+    def report_timing(self):
+        n, total = len(self.timing["process"]), self.timing["total"]
+        for stage in ("capture", "process"):
+            t = np.array(self.timing[stage])
+            if len(t):
+                print(f"{stage:>8}: {len(t)} scans, {t.mean()*1e3:.1f} ms/scan, {t.sum():.2f} s")
+        if n:
+            print(f"{'total':>8}: {total:.2f} s, {n/total:.2f} scans/s")
 
     def exit(self):
         self.prj.exit()
         self.hkc.exit()
 
-from config import config
-cfg = config()  
-
-cap = Capture(cfg)
-# cap.calibra_capture()
-cap.measure_capture()
-
-cap.exit()
 
+if __name__ == '__main__':
+    cfg = config()
 
+    cap = Capture(cfg)
+    # cap.calibra_capture()
+    cap.measure_capture()
 
+    cap.exit()
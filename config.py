@@ -12,6 +12,7 @@ def config():
     # The fringe pattern generation ****************************************************
     cfg.pattern_size = [1920, 1080]
     cfg.pattern_path = './data/patterns'
+    cfg.pattern_source = "bank"  # "bank": the Projector takes the patterns from memory, "files": the BMPs in pattern_path
 
     #--- The sine wave projection patten  I(x)=A + B*sin(\pi x/T+\phi_0)
     cfg.scale = 3.0 # the projector resolution divides the camera resolution
@@ -19,33 +20,63 @@ def config():
     cfg.Tc = [14, 15, 16]  # measurement
     cfg.Tp = [cfg.scale*T for T in cfg.Tc] #cfg.scale*cfg.Tc 
     # print("Tp", cfg.Tp)
-    cfg.A = [128,128,128]
-    cfg.B = [96,96,96]
+    cfg.A = [128]*len(cfg.Tc)
+    cfg.B = [96]*len(cfg.Tc)
     step  = 3
-    cfg.steps = [step,step,step]
+    cfg.steps = [step]*len(cfg.Tc)  # per frequency, e.g. [4, 3, 3]
     cfg.light_value = 250
     cfg.hv = "h" # "h" "v"---horizontal or vertical
 
 
-    cfg.alpha = [1, cfg.Tp[0]/cfg.Tp[1], cfg.Tp[0]/cfg.Tp[2]]
+    cfg.alpha = [cfg.Tp[0]/T for T in cfg.Tp]
     cfg.gamma = 1.25
     cfg.C, cfg.D = 4, 3
 
     # **********************************************************************************
     # The images recording *************************************************************
     cfg.img_sz= (640,480) # I don't have a high resolution industrial camera at hand
+    cfg.exposure = 8/24  # seconds a pattern is shown before the camera is triggered
+    cfg.pipeline_depth = 2  # captured scans waiting for the reconstruction in Capture.measure_pipeline
     cfg.calibra_path = './data/calibrations/2'
+    cfg.calibra_poses = 22  # the poses 00..poses-1 recorded for calibration
+    cfg.calibra_workers = 4  # poses read and processed concurrently
+    cfg.calibra_artifact = "artifact"  # folder under calibra_path with the memory-mapped calibration for Recons3D, None to read the npz
+    cfg.calibra_cache = "cache"  # folder under calibra_path keeping the points of each pose, None to disable
+    cfg.calibra_scans = None  # scan container under calibra_path with the poses (scans.py), e.g. "scans.scan"; None for the BMPs
     cfg.measure_path = './data/recordings/2/'
+    cfg.measure_scans = None  # scan container under measure_path (scans.py), e.g. "scans.scan"; None for the BMPs
+    cfg.record_steps = None  # list of the steps per frequency in the recordings, e.g. [12, 12, 12] as in Exp2, subsampled to cfg.steps; None to infer them from the frame count
+    cfg.record_gamma = None  # gamma applied to the recorded fringes on load, e.g. 0.8 as in Exp2, None to keep them 8-bit
+    cfg.batch_prefetch = 2  # scans decoded ahead of the reconstruction in Recons3D.measure_batch
+    cfg.batch_workers = 4  # threads decoding the scans of Recons3D.measure_batch
     
     # **********************************************************************************
     # phase extraction method **********************************************************
     cfg.pe_method = "PE"  # "PE", "LLS", "MPE", "CFPE"
+    cfg.tile_size = None  # (w, h): extract the phase tile by tile to bound the memory, None for full frame
+    cfg.workers = 1  # threads for the phase extraction, the frame is split into row bands
+    cfg.precision = "auto"  # "auto" (follow the images, float32 for 8-bit), "float32", "mixed" (float32, float64 sums), "float64"
+    cfg.stream_refresh = 100  # full cycles of StreamPE between exact recomputations of its running sums
+    cfg.min_modulation = None  # skip the pixels whose modulation b1 is lower, NaN phase; None to keep all
+    cfg.min_brightness = None  # skip the pixels whose mean brightness is lower, NaN phase; None to keep all
+    cfg.unwrap = "heterodyne"  # "heterodyne", "lut": fringe order looked up from the quantized beat phases
+    cfg.lut_bins = 256  # cells of each beat phase for the "lut" unwrapping, the wrapped phases are quantized to 16*lut_bins levels
 
 
 #     # The image processing
 #     cfg.GCME = True # "None", ""
 
     cfg.MaxIter = 6
+    cfg.tol = None  # freeze a pixel once its phase increment falls below tol, None to always run MaxIter
+    cfg.warm_start = False  # CFPE: seed each scan with the phase of the previous one where it still fits
+    cfg.warm_check = 0.3  # rad, the largest misfit of the previous phase to the new wrapped phases for a warm pixel
+    cfg.warm_iter = 1  # the iterations of a warm pixel, the others run MaxIter
+    cfg.lls_solver = "ldl"  # "ldl": normal equations solved per pixel, "pinv": pseudo-inverse reference
+
+    # **********************************************************************************
+    # 3D reconstruction ****************************************************************
+    cfg.pe_mask = True  # extract the phase only inside the rectified ROI and on the bright pixels
+    cfg.disp_method = "lookup"  # "lookup": inverse phase table of each rectified row, "iterative": fixed-point remaps
     return cfg
 
 # def config():
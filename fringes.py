@@ -2,6 +2,8 @@ import numpy as np
 import cv2
 from pathlib import Path
 
+from config import AttrDict
+
 
 # synthetic fringe images
 class Fringes():
@@ -13,12 +15,18 @@ class Fringes():
         img = np.zeros([H, W])
         return img+self._c.light_value
 
+    def profile(self, zeta, T, A, B, W=None):
+        """The 1-D fringe, (W,) along x for "h" or (H, 1) along y for "v", a frame broadcasts it"""
+        W = self._c.pattern_size[0] if W is None else W
+        H = self._c.pattern_size[1]
+        x = np.linspace(0,W-1,W) if self._c.hv == "h" else np.linspace(0,H-1,H).reshape(-1,1) 
+        y = A+B*np.cos(2*np.pi*x/T+zeta) 
+        return y
+
     def generate_one(self, zeta, T, A, B):
         W, H = self._c.pattern_size
         img = np.zeros([H, W])
-        x = np.linspace(0,W-1,W) if self._c.hv == "h" else np.linspace(0,H-1,H).reshape(-1,1) 
-        y = A+B*np.cos(2*np.pi*x/T+zeta) 
-        return img+y
+        return img+self.profile(zeta, T, A, B)
     
     def generate_steps(self, T, A, B, step):
         assert step >= 3
@@ -64,9 +72,11 @@ class Fringes_Seg(Fringes):
         
     def init_T123(self):
         mT = lambda T1, T2: T1*T2/(T2-T1)
-        T12 = mT(self._c.Tp[0],self._c.Tp[1])
-        T23 = mT(self._c.Tp[1],self._c.Tp[2])
-        T123 = mT(T12, T23)
+        # slide the beats of neighbouring periods down to one, T123 for three frequencies
+        Ts = list(self._c.Tp)
+        while len(Ts) > 1:
+            Ts = [mT(Ta, Tb) for Ta, Tb in zip(Ts, Ts[1:])]
+        T123 = Ts[0]
         T1 = self._c.Tp[0]
         
         # obtain the del index
@@ -78,20 +88,26 @@ class Fringes_Seg(Fringes):
         mask = (ind>-1)*(ind<self._c.pattern_size[0])
         self.ind = ind[mask]        
         
-    def generate_one(self, zeta, T, A, B):
-        self._c.pattern_size[0] +=200
-        y = super().generate_one(zeta,T,A,B)
-        self._c.pattern_size[0] -=200
-        y = np.delete(y, self.ind, 1)
-        y = y[:,0:(self._c.pattern_size[0])]
+    def profile(self, zeta, T, A, B, W=None):
+        W = self._c.pattern_size[0] if W is None else W
+        y = super().profile(zeta,T,A,B, W+200)
+        if self._c.hv == "h": # a "v" profile is constant along the deleted columns
+            y = np.delete(y, self.ind)[0:W]
         return y
+
+    def generate_phase(self):
+        # the columns left by the deletion, the patterns jump over whole periods of Tp[0]
+        W, H = self._c.pattern_size
+        x = np.delete(np.linspace(0,W+199,W+200), self.ind)[0:W]
+        phase = np.zeros([H, W])+2*np.pi*x/self._c.Tp[0]
+        return phase
         
     
 class Fringes_Gamma(Fringes):
     def __init__(self, config):
         super().__init__(config)
-    def generate_one(self, zeta, T, A, B):
-        y = super().generate_one(zeta,T,A,B)
+    def profile(self, zeta, T, A, B, W=None):
+        y = super().profile(zeta,T,A,B, W)
         y = 255*np.power(y/255, self._c.gamma) 
         y = np.round(y)
         return y 
@@ -100,20 +116,52 @@ class Fringes_Gamma(Fringes):
 class Fringes_Harmonics(Fringes):
     def __init__(self, config):
         super().__init__(config)
-    def generate_one(self, zeta, T, A, B):
-        W, H = self._c.pattern_size
-        img = np.zeros([H, W])
+    def profile(self, zeta, T, A, B, W=None):
+        W = self._c.pattern_size[0] if W is None else W
+        H = self._c.pattern_size[1]
         # x = np.linspace(0,W-1,W)
         x = np.linspace(0,W-1,W) if self._c.hv == "h" else np.linspace(0,H-1,H).reshape(-1,1) 
         phi = 2*np.pi*x/T+zeta
         y = A+B*np.cos(phi)
         h = self._c.C*np.cos(2*phi)+self._c.D*np.cos(4*phi)
-        return np.round(img+y+h)
+        return np.round(y+h)
  
 def fringe_wrapper(cfg, method):
     assert method in ["fringe","gamma","harmonic", "seg"]
     d = {"fringe":Fringes,"gamma":Fringes_Gamma,"harmonic":Fringes_Harmonics,"seg":Fringes_Seg}
     return d[method](cfg)
+
+
+class PatternBank():
+    """The 8-bit patterns of a fringe model, in the order of the Projector: frames[hv] holds the
+    fringes of every frequency and step, and the background for "h". Each 1-D profile is
+    computed once, a frame is a read-only broadcast (H, W) view of it."""
+    def __init__(self, config, model="fringe"):
+        W, H = config.pattern_size
+        self.steps = list(config.steps)
+        u8 = lambda y: np.broadcast_to(np.clip(np.round(y), 0, 255).astype(np.uint8), (H, W))
+        self.frames = dict()
+        for hv in "hv":
+            c = AttrDict(config)
+            c.hv = hv
+            fringes = fringe_wrapper(c, model)
+            self.frames[hv] = [u8(fringes.profile(zeta, T, A, B)) for T, A, B, step in zip(c.Tp, c.A, c.B, c.steps)
+                    for zeta in np.linspace(0, step-1, step)*2*np.pi/step]
+        self.frames["h"].append(u8(np.array(config.light_value)))
+    
+    def images(self, hv="h"):
+        """The fringe frames as a list (frequencies) of lists (steps), as phase_extract takes them"""
+        cuts = np.cumsum([0]+self.steps)
+        return [self.frames[hv][a:b] for a, b in zip(cuts[:-1], cuts[1:])]
+
+
+_banks = dict()
+def pattern_bank(cfg, model="fringe"):
+    """The PatternBank of cfg, cached by the config values the patterns depend on"""
+    key = (model,)+tuple(repr(cfg[k]) for k in ("pattern_size","Tp","A","B","steps","gamma","C","D","light_value"))
+    if key not in _banks:
+        _banks[key] = PatternBank(cfg, model)
+    return _banks[key]
     
     
 def projection_fringes_save():
@@ -4,23 +4,198 @@ The phase extraction methods in this work
 - the baseline method (LLS) 
 - our cross-frequency phase extraction (CFPE)
 - one multifrequency phase extraction (MPE) method --- ablation method of our CFPE
+
+The fringe images are given as one (F, S, H, W) array (uint8 or float32), or as a list
+(frequencies) of lists (steps) of 2-D images. Any number of frequencies works, one period
+in cfg.Tc each, and the step count may differ per frequency, e.g. 4+3+3 (list input).
 """
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
 import cv2
 
+from profiler import profiler
+
+
+# stacked input: one (S, H, W) array per frequency
+def as_stack(images):
+    """Per-frequency (S, H, W) stacks of a fringe sequence, given either one contiguous
+    (F, S, H, W) array or a list (frequencies) of lists (steps) of 2-D images"""
+    if isinstance(images, np.ndarray):
+        assert images.ndim == 4, "expect a (F, S, H, W) array"
+        return list(images)
+    return [np.asarray(imgs) for imgs in images]
+
+
+@lru_cache()
+def step_weights(steps, orders=(1,)):
+    """The weight table [cos(k*delta_s); sin(k*delta_s)] for each order k, delta_s = 2*pi*s/steps"""
+    delta = 2*np.pi*np.arange(steps)/steps
+    w = np.concatenate([(np.cos(k*delta), np.sin(k*delta)) for k in orders])
+    w.flags.writeable = False
+    return w
+
+
+@lru_cache()
+def fringe_order_table(T1, T2, T3, bins=256):
+    """The fringe order lookup for three-frequency unwarping. With T12=T1*T2/(T2-T1) and
+    T23=T2*T3/(T3-T2), the beat phases b12 and b23 unwrapped by the first heterodyne level give
+    b12/2pi = frac(x/T12) and b23/2pi = frac(x/T23) at a position x < T123. For every cell of the
+    quantized (b12, b23) in [0, 2pi)^2 the table keeps the order m12 of the T12 beat whose
+    predicted b23 is the closest. The beats carry the noise of psi1 only, divided by R12 and
+    R23, so a cell is ambiguous when its b23 is off the prediction by more than an eighth of the
+    gap between two candidate orders. The order is kept as round(R12*(m12-w)), the fringe order
+    of psi1 less the n12 of the first level, for the b12 that wrapped w = -1, 0, 1 times into
+    [0, 2pi). Returns (order, ambiguous), both flat (3*bins*bins,), row (w+1)*bins+cell12"""
+    assert T1 < T2 < T3, "please change the order of input"
+    T12, T23 = T1*T2/(T2-T1), T2*T3/(T3-T2)
+    assert T23 > T12, "please change the order of input"
+    T123 = T12*T23/(T23-T12)
+    m12 = np.arange(int(np.ceil(T123/T12-1e-9)))
+    b = 2*np.pi*(np.arange(bins)+0.5)/bins  # the cell centers
+    # b23 predicted by each order m12 for each b12, shape (bins, M), the orders past T123 excluded
+    x = T12*(m12+b[:, None]/(2*np.pi))
+    pred = 2*np.pi*np.mod(x/T23, 1)
+    # wrapped distance of each b23 to each prediction, shape (bins, bins, M)
+    r = np.abs(np.angle(np.exp(1j*(b[None, :, None]-pred[:, None, :]))))
+    r[np.broadcast_to((x >= T123)[:, None, :], r.shape)] = np.inf
+    best, residual = np.argmin(r, axis=-1), np.min(r, axis=-1)
+    gap = np.diff(np.sort(np.mod(m12*T12/T23, 1)).tolist()+[1]).min()*2*np.pi if len(m12) > 1 else 2*np.pi
+    
+    w = np.arange(-1, 2)[:, None, None]
+    order = np.round(T12/T1*(best-w)).astype(np.int32).ravel()
+    ambiguous = np.tile(residual > gap/8, (3, 1)).ravel()
+    order.flags.writeable, ambiguous.flags.writeable = False, False
+    return order, ambiguous
+
+
+@lru_cache()
+def beat_table(Ta, Tb, bins=256, rows=256, levels=4096, wraps=True):
+    """The first heterodyne level as a lookup: for psi_a quantized to rows and the wrapped
+    psi_a-psi_b to levels (finer, its error is scaled by R=Tb/(Tb-Ta)), the order n of
+    phase_unwarping2, the cell of its beat b=(psi_a+2pi*n)/R in the bins of [0, 2pi), offset by
+    bins*(w+1) for b wrapped w times if wraps, and whether n is within 0.1 of a tie. Returns
+    (cell, n, tie), flat ((rows+1)*levels,) indexed by row*levels+level, the last row for
+    psi_a=2pi"""
+    R = Tb/(Tb-Ta)
+    psi = 2*np.pi*(np.arange(rows+1)[:, None]+0.5)/rows  # the cell centers
+    d = 2*np.pi*(np.arange(levels)+0.5)/levels
+    k = (d*R-psi)/(2*np.pi)
+    n = np.round(k)
+    b = (psi+2*np.pi*n)/R
+    w = np.floor(b/(2*np.pi))
+    cell = np.minimum(((b-2*np.pi*w)*(bins/(2*np.pi))).astype(np.int32), bins-1)
+    if wraps:
+        cell += bins*(w.astype(np.int32)+1)
+    cell, n, tie = cell.ravel(), n.astype(np.int16).ravel(), (np.abs(k-n) > 0.4).ravel()
+    for x in (cell, n, tie):
+        x.flags.writeable = False
+    return cell, n, tie
+
+
+def step_moments(imgs, orders=(1,), dtype=None):
+    """sum_s cos(k*delta_s)*img_s and sum_s sin(k*delta_s)*img_s for each order k,
+    as a single contraction of the (S, H, W) stack with the weight table"""
+    imgs = np.asarray(imgs)
+    # by default keep the precision of the images, i.e. float32 for 8-bit images
+    dtype = np.result_type(np.float32, imgs) if dtype is None else dtype
+    w = step_weights(len(imgs), tuple(orders)).astype(dtype)
+    return np.tensordot(w, imgs.astype(dtype, copy=False), axes=1)
+
+
+# trig-recurrence engine
+# zeta_s = theta+2*pi*s/steps, so every per-step sum in the CFPE/MPE loops follows from
+# sin/cos of theta by angle addition; one sin/cos pass per frequency replaces 3*steps passes
+def multiple_angle(sin1, cos1, n):
+    """sin(n*theta), cos(n*theta) from sin(theta), cos(theta) with the Chebyshev recurrence"""
+    s0, c0, s, c = 0., 1., sin1, cos1
+    if n == 0:
+        return s0, c0
+    for k in range(1, n):
+        s, s0 = 2*cos1*s-s0, s
+        c, c0 = 2*cos1*c-c0, c
+    return s, c
+
+
+def solve_sym4(A, b, rcond=1e-8, out=None):
+    """Per-pixel solution of the symmetric 4x4 systems A*x = b, with A given by its 10 upper
+    entries (row by row), via a closed-form LDL^T factorization. A pivot below rcond times
+    its diagonal entry marks a singular pixel; that component is set to zero instead.
+    out: callable(name, dtype) giving the array of each factor, intermediate and result,
+    e.g. from a workspace; fresh arrays by default. The results are written over y1..y3."""
+    a00, a01, a02, a03, a11, a12, a13, a22, a23, a33 = A
+    dtype = np.result_type(a00, b[0])
+    out = out or (lambda name, dtype: np.empty(np.shape(a00), dtype))
+    buf = lambda name: out(name, dtype)
+    mul = lambda x, y, name="tmp": np.multiply(x, y, out=buf(name))
+    sub = lambda x, y, name: np.subtract(x, y, out=buf(name))
+    
+    def inv(d, a, name):
+        ok = np.greater(d, mul(rcond, a), out=out("ok", bool))
+        i = buf(name)
+        i.fill(0)
+        return np.divide(1., d, out=i, where=ok)
+    
+    def dot(z, x, y, w=None):  # z -= x*y*w
+        t = mul(x, y)
+        if w is not None:
+            t *= w
+        z -= t
+        return z
+    
+    i0 = inv(a00, a00, "i0")
+    l10, l20, l30 = mul(a01, i0, "l10"), mul(a02, i0, "l20"), mul(a03, i0, "l30")
+    d1 = sub(a11, mul(l10, a01), "d1")
+    i1 = inv(d1, a11, "i1")
+    l21, l31 = sub(a12, mul(l20, a01), "l21"), sub(a13, mul(l30, a01), "l31")
+    l21 *= i1
+    l31 *= i1
+    d2 = dot(sub(a22, mul(l20, a02), "d2"), l21, l21, d1)
+    i2 = inv(d2, a22, "i2")
+    l32 = dot(sub(a23, mul(l30, a02), "l32"), l31, l21, d1)
+    l32 *= i2
+    d3 = dot(dot(sub(a33, mul(l30, a03), "d3"), l31, l31, d1), l32, l32, d2)
+    i3 = inv(d3, a33, "i3")
+    
+    y0 = b[0]
+    y1 = sub(b[1], mul(l10, y0), "y1")
+    y2 = dot(sub(b[2], mul(l20, y0), "y2"), l21, y1)
+    y3 = dot(dot(sub(b[3], mul(l30, y0), "y3"), l31, y1), l32, y2)
+    x3 = np.multiply(y3, i3, out=y3)
+    x2 = dot(np.multiply(y2, i2, out=y2), l32, x3)
+    x1 = dot(dot(np.multiply(y1, i1, out=y1), l21, x2), l31, x3)
+    x0 = dot(dot(dot(mul(y0, i0, "x0"), l10, x1), l20, x2), l30, x3)
+    return x0, x1, x2, x3
+
+
+def tiles(shape, tile_size, halo=0):
+    """(core, box) slices of the tiles covering an image of the given (H, W) shape; the box
+    is the core tile of at most tile_size=(w, h) pixels grown by halo pixels on each side"""
+    H, W = shape
+    tw, th = tile_size
+    for y in range(0, H, th):
+        for x in range(0, W, tw):
+            core = (slice(y, min(y+th, H)), slice(x, min(x+tw, W)))
+            box = tuple(slice(max(c.start-halo, 0), min(c.stop+halo, n)) for c, n in zip(core, shape))
+            yield core, box
+
 
 # standard phase extractor (PE)
 class PE():
+    halo = 0 # the pixel-wise extraction needs no neighbours
+
     def __init__(self, config):
         self._c = config
+        self._workspace = dict()
+        self.debug = config.debug
         
-    def psi_extract(self, images):
-        """The wrapped phase: psi"""
-        steps = len(images)
-        den, num = 0,0
-        for step in range(steps):
-            num += np.sin(2*np.pi*step/steps)*images[step]
-            den += np.cos(2*np.pi*step/steps)*images[step]
+    def psi_extract(self, images, moments=None):
+        """The wrapped phase: psi, from a (S, H, W) stack (or a list of frames) or its first-order
+        moments"""
+        if moments is None:
+            images = np.asarray(images)
+            moments = step_moments(images, dtype=self._dtype([images]))
+        den, num = moments[:2]
         psi = np.mod(-np.arctan2(num, den), 2*np.pi)
         return psi
 
@@ -61,186 +236,671 @@ class PE():
     def phase_unwarping3(self, psi1, psi2, psi3, T1, T2, T3):
         """ for three frequencies
         """
-        phase12, T12 = self.phase_unwarping2(psi1, psi2, T1, T2)
-        phase23, T23 = self.phase_unwarping2(psi2, psi3, T2, T3)
+        return self.phase_unwarping([psi1, psi2, psi3], [T1, T2, T3])
+    
+    def phase_unwarping(self, psi, Tc):
+        """ for any number of frequencies, T1<T2<...: the heterodyne of neighbouring phases is
+        slid level by level down to two beats, whose order is then resolved against psi1.
+        It reduces to phase_unwarping2 for two and to phase_unwarping3 for three frequencies
+        """
+        if len(psi) == 1:
+            return psi[0], Tc[0]
+        phases, periods = list(psi), list(Tc)
+        while len(phases) > 2:
+            phases, periods = zip(*[self.phase_unwarping2(phases[i], phases[i+1], periods[i], periods[i+1]) 
+                    for i in range(len(phases)-1)])
+        (phase_a, phase_b), (T_a, T_b) = phases, periods
         
-        assert T23>T12, "please change the order of input"
-        phase123 = phase12-phase23
-        phase123 = np.mod(phase123, 2*np.pi)
+        assert T_b>T_a, "please change the order of input"
+        phase = phase_a-phase_b
+        phase = np.mod(phase, 2*np.pi)
         
-        T123 = T12*T23/(T23-T12)
-        R = T123/T1
+        T = T_a*T_b/(T_b-T_a)
+        R = T/Tc[0]
 
-        n = np.round((phase123*R-psi1)/(2*np.pi))
-        phase123 = (psi1 + 2*n*np.pi)/R
+        n = np.round((phase*R-psi[0])/(2*np.pi))
+        phase = (psi[0] + 2*n*np.pi)/R
+        return phase, T
+    
+    def phase_unwarping3_lut(self, psi1, psi2, psi3, T1, T2, T3):
+        """phase_unwarping3 by integer lookups: the wrapped phases are quantized once, the first
+        heterodyne level is read from beat_table() and the order of the T12 beat from
+        fringe_order_table(). Sets self.ambiguous, the pixels whose order could not be resolved
+        reliably: off the table, or with a first level order within 0.1 of a tie"""
+        bins = self._c.lut_bins
+        levels = 16*bins  # the rows of psi_a are levels >> 4
+        order, ambiguous = fringe_order_table(T1, T2, T3, bins)
+        cell12, n12, tie12 = beat_table(T1, T2, bins, bins, levels)
+        cell23, _, tie23 = beat_table(T2, T3, bins, bins, levels, wraps=False)
+        
+        q1, q2, q3 = [(psi*(levels/(2*np.pi))).astype(np.int32) for psi in (psi1, psi2, psi3)]
+        def index(qa, qb):  # row of qa, level of the wrapped qa-qb, qa is consumed
+            i = np.subtract(qa, qb)
+            i &= levels-1
+            qa >>= 4
+            qa *= levels
+            i += qa
+            return i
+        i12, i23 = index(q1, q2), index(q2, q3)
+        idx = cell12.take(i12, mode="clip")
+        idx *= bins
+        idx += cell23.take(i23, mode="clip")
+        self.ambiguous = ambiguous.take(idx, mode="clip")
+        self.ambiguous |= tie12.take(i12, mode="clip")
+        self.ambiguous |= tie23.take(i23, mode="clip")
+        
+        T12, T23 = T1*T2/(T2-T1), T2*T3/(T3-T2)
+        T123 = T12*T23/(T23-T12)
+        # n = round(R12*(m12+b12/2pi) - psi1/2pi) = round(R12*(m12-w)) + n12
+        n = order.take(idx, mode="clip")
+        n += n12.take(i12, mode="clip")
+        phase123 = n.astype(psi1.dtype)
+        phase123 *= 2*np.pi
+        phase123 += psi1
+        phase123 /= T123/T1
         return phase123, T123
     
-    def basic_extract(self, images):
+    def basic_extract(self, images, moments=None):
         # extract psi
+        images = as_stack(images)
+        moments = [None]*len(images) if moments is None else moments
         psi = list()
-        for pattens in images:
-            psi.append(self.psi_extract(pattens))
-        assert len(psi)==3
-        phi1, T1 = self.phase_unwarping3(psi[0],psi[1],psi[2],self._c.Tc[0],self._c.Tc[1],self._c.Tc[2])
+        for pattens, m in zip(images, moments):
+            with profiler.stage("psi", pixels=pattens[0].size):
+                psi.append(self.psi_extract(pattens, m))
+        return self.unwrap(psi)
+    
+    def unwrap(self, psi):
+        """The phase of the first frequency and the period it is unwrapped to, from the
+        wrapped phases of every frequency"""
+        assert len(psi)==len(self._c.Tc), "one period in cfg.Tc per frequency"
+        self.ambiguous = None
+        with profiler.stage("unwrap", pixels=psi[0].size, method=self._c.unwrap):
+            if self._c.unwrap == "lut":
+                assert len(psi)==3, "the lut unwarping resolves three frequencies"
+                phi1, T1 = self.phase_unwarping3_lut(*psi, *self._c.Tc)
+            else:
+                phi1, T1 = self.phase_unwarping(psi, self._c.Tc)
         phi1 = phi1*T1/self._c.Tc[0]
-        phi1 = phi1.astype(np.float32)
+        phi1 = phi1.astype(self._phase_dtype())
         return phi1, T1
     
-    def phase_extract(self, images):
-        """The interface for other high-order method"""
-        return self.basic_extract(images)
+    def phase_extract(self, images, mask=None, debug=None):
+        """The interface for other high-order method. mask: optional (H, W) bool, e.g. the
+        calibration ROI, the phase is only extracted at the valid_pixels() and NaN elsewhere.
+        debug: the debug output of this extraction, cfg.debug by default"""
+        self.debug = self._c.debug if debug is None else debug
+        with profiler.stage("phase_extract", method=type(self).__name__) as stage:
+            if self._c.tile_size or self._c.workers > 1:
+                phase, T1 = self.phase_extract_tiled(images, self._c.tile_size, self._c.workers, mask)
+            else:
+                phase, T1 = self._extract(images, mask)
+            stage.add(pixels=phase.size, nbytes=phase.nbytes)
+        return phase, T1
+    
+    def _extract(self, images, mask=None):
+        images = as_stack(images)
+        phi1, T1 = self.basic_extract(images)
+        valid = self.valid_pixels(images, mask=mask)
+        if valid is not None:
+            phi1[~valid] = np.nan
+        return phi1, T1
+    
+    def valid_pixels(self, images, moments=None, mask=None):
+        """The pixels worth extracting: inside mask, with the modulation b1 (of the first
+        frequency) at least cfg.min_modulation and the mean brightness at least
+        cfg.min_brightness. None when every pixel is valid"""
+        valid = None if mask is None else np.asarray(mask, bool)
+        if self._c.min_modulation:
+            mc, ms = step_moments(images[0], dtype=self._dtype(images))[:2] if moments is None else moments[0][:2]
+            b1 = np.sqrt(mc*mc+ms*ms)*(2/len(images[0]))
+            valid = b1 >= self._c.min_modulation if valid is None else valid & (b1 >= self._c.min_modulation)
+        if self._c.min_brightness:
+            b0 = images[0].mean(axis=0, dtype=np.float32)
+            valid = b0 >= self._c.min_brightness if valid is None else valid & (b0 >= self._c.min_brightness)
+        return valid
+    
+    def phase_extract_tiled(self, images, tile_size=None, workers=1, mask=None):
+        """phase_extract on tiles of at most tile_size=(w, h) pixels, each cut out with a halo
+        of self.halo pixels so that the stitched phase equals the full-frame one.
+        With workers>1 the tiles (by default one row band per worker) run in a thread pool,
+        NumPy and OpenCV release the GIL; the result is bit-identical to the serial path.
+        self.active_counts of the iterative methods sums the tiles per iteration, the halo
+        pixels counted with every tile they belong to."""
+        images = as_stack(images)
+        phase = np.empty(images[0].shape[-2:], self._phase_dtype())
+        ambiguous = np.zeros(phase.shape, bool) if self._c.unwrap == "lut" else None
+        if tile_size is None:
+            H, W = phase.shape
+            tile_size = (W, -(-H//workers))
+        
+        def extract(core, box):
+            # every worker needs its own extractor, the methods keep their state in self
+            pe = self if workers == 1 else type(self)(self._c)
+            pe.debug = self.debug
+            phi1, T1 = pe._extract([imgs[(slice(None),)+box] for imgs in images], 
+                    None if mask is None else mask[box])
+            inner = tuple(slice(c.start-b.start, c.stop-b.start) for c, b in zip(core, box))
+            phase[core] = phi1[inner]
+            if ambiguous is not None:
+                ambiguous[core] = pe.ambiguous[inner]
+            return T1, getattr(pe, "active_counts", None)
+        
+        jobs = list(tiles(phase.shape, tile_size, self.halo))
+        if workers == 1:
+            results = [extract(*job) for job in jobs]
+        else:
+            with ThreadPoolExecutor(workers) as pool:
+                results = list(pool.map(lambda job: extract(*job), jobs))
+        T1s, counts = zip(*results)
+        if counts[0] is not None:
+            self.active_counts = [sum(c[it] for c in counts if it < len(c)) 
+                    for it in range(max(len(c) for c in counts))]
+        self.ambiguous = ambiguous
+        return phase, T1s[0]
+    
+    def _buffer(self, name, shape, dtype):
+        """A scratch array of the workspace. The buffers are kept per (name, dtype) and grow to
+        the largest shape asked for, so repeated same-sized extractions allocate nothing"""
+        key, size = (name, np.dtype(dtype)), int(np.prod(shape))
+        buf = self._workspace.get(key)
+        if buf is None or buf.size < size:
+            buf = self._workspace[key] = np.empty(size, dtype)
+        return buf[:size].reshape(shape)
+    
+    def workspace_nbytes(self):
+        """The memory held by the workspace"""
+        return sum(buf.nbytes for buf in self._workspace.values())
+    
+    def release_workspace(self):
+        self._workspace.clear()
+    
+    def _moments(self, f, imgs, orders=(1,), dtype=np.float32):
+        """step_moments() of frequency f, computed in the workspace"""
+        S = len(imgs)
+        with profiler.stage("moments", pixels=imgs[0].size, nbytes=imgs.nbytes):
+            w = step_weights(S, tuple(orders)).astype(dtype)
+            x = self._buffer("images", imgs.shape, dtype)
+            np.copyto(x, imgs)
+            m = self._buffer(f"moments{f}", (len(w),)+imgs.shape[1:], dtype)
+            np.dot(w, x.reshape(S, -1), out=m.reshape(len(w), -1))
+        return m
+    
+    def _multiple_angle(self, sin1, cos1, n):
+        """multiple_angle() computed in the workspace"""
+        if n < 2:
+            return multiple_angle(sin1, cos1, n)
+        two_cos = np.multiply(2, cos1, out=self._buffer("two_cos", cos1.shape, cos1.dtype))
+        
+        def chain(name, x0, x1):
+            bufs = [self._buffer(f"{name}{i}", x1.shape, x1.dtype) for i in range(3)]
+            for k in range(1, n):
+                x2 = next(b for b in bufs if b is not x0 and b is not x1)
+                np.multiply(two_cos, x1, out=x2)
+                np.subtract(x2, x0, out=x2)
+                x0, x1 = x1, x2
+            return x1
+        return chain("sin_n", 0., sin1), chain("cos_n", 1., cos1)
+    
+    def _dtype(self, images):
+        """The storage dtype of the precision policy cfg.precision, for the per-frequency stacks"""
+        if self._c.precision == "auto":
+            return np.result_type(np.float32, *images)
+        return np.float64 if self._c.precision == "float64" else np.float32
+    
+    def _acc_dtype(self):
+        """The dtype of the normal-equation sums"""
+        return np.float32 if self._c.precision == "float32" else np.float64
+    
+    def _phase_dtype(self):
+        return np.float64 if self._c.precision == "float64" else np.float32
+    
+    def _median(self, phi1):
+        """The 5x5 median filter of the initial phase, OpenCV filters float32 only"""
+        with profiler.stage("median", pixels=phi1.size):
+            return cv2.medianBlur(phi1.astype(np.float32, copy=False), 5).astype(phi1.dtype, copy=False)
+    
+    def _iterate(self, update, theta, data, valid=None, budget=None):
+        """Run the MaxIter updates theta += update(theta, data) of the iterative methods.
+        theta: per-pixel (H, W) parameters, the phase last; data: (..., H, W) arrays that stay
+        fixed over the iterations. With cfg.tol, a pixel whose phase increment falls below tol
+        is frozen, and later iterations only run on the compacted array of active pixels, as
+        a pixel is once it has run its (H, W) budget of iterations, if given.
+        Only the valid pixels are iterated, the phase of the others is set to NaN."""
+        flat = [x.reshape(-1) for x in theta]
+        active = flat
+        data = [d.reshape(d.shape[:-2]+(-1,)) for d in data]
+        budget = None if budget is None else budget.reshape(-1)
+        index = None # None for all pixels
+        if valid is not None:
+            index = np.flatnonzero(valid)
+            active = [x[index] for x in flat]
+            data = [d[..., index] for d in data]
+            budget = None if budget is None else budget[index]
+        
+        self.active_counts = []
+        for it in range(self._c.MaxIter):
+            if index is not None and index.size == 0:
+                break
+            self.active_counts.append(active[-1].size)
+            with profiler.stage("iteration", pixels=active[-1].size, it=it) as stage:
+                d_theta = update(active, data)
+                for x, dx in zip(active, d_theta):
+                    x += dx
+                if index is not None:
+                    for x, a in zip(flat, active):
+                        x[index] = a
+                # the mean phase increment, a full reduction, only for the tol, debug or a profiler sink
+                step, report = None, self.debug or profiler.enabled
+                change = np.abs(d_theta[-1]) if self._c.tol or report else None
+                if report:
+                    step = float(np.mean(change))
+                    stage.add(step=step)
+            if self.debug:
+                print(f"\t\t The mean increasing amount of phi:{step:3g}")
+            
+            keep = None
+            if self._c.tol:
+                keep = change >= self._c.tol
+            if budget is not None:
+                keep = budget > it+1 if keep is None else keep & (budget > it+1)
+            if keep is not None and not keep.all():
+                index = np.flatnonzero(keep) if index is None else index[keep]
+                active = [a[keep] for a in active]
+                data = [d[..., keep] for d in data]
+                budget = None if budget is None else budget[keep]
+        if valid is not None:
+            flat[-1][~valid.reshape(-1)] = np.nan
 
 
 # LLS method
 class LLS(PE):
+    halo = 2 # the 5x5 median filter of the initial phase
+
     def __init__(self, config):
         super(LLS, self).__init__(config)
 
         self.b0, self.b1 = 0, 0
         self.bN, self.phi1 = 0, 0
         
-    def phase_extract(self, images):
-        self.phi1, T1 = self.basic_extract(images)
-        self.phi1 = cv2.medianBlur(self.phi1, 5)      
+    def _extract(self, images, mask=None):
+        images = as_stack(images)
+        dtype = self._dtype(images)
+        moments = [self._moments(f, imgs, dtype=dtype) for f, imgs in enumerate(images)]
+        self.phi1, T1 = self.basic_extract(images, moments)
+        self.phi1 = self._median(self.phi1)
 
         self.images = images
-        self._init_param()
+        self._init_param(moments[0])
         
         # update via LSM 
-        for it in range(self._c.MaxIter):
-            Omega, Delta = list(), list()
-            for j, patterns in enumerate(images):
-                step = len(patterns)
-                deltas = 2*np.pi*np.linspace(0, step-1, step)/step
-                alpha = self._c.alpha[j]
-                for s, img in enumerate(patterns):
-                    img_fit = self._func(alpha, deltas[s], step-1)
-                    grad_theta = self._grad_func(alpha, deltas[s], step-1)
-                    grad_theta = np.stack(grad_theta, axis=-1)
-                    Delta.append(img-img_fit)
-                    Omega.append(grad_theta)
-                    
-            Delta = np.stack(Delta, axis=-1)
-            Delta = np.expand_dims(Delta, axis=-1)
-            Omega = np.stack(Omega, axis=-2)
-            Omega_t = np.swapaxes(Omega,-1,-2)
-            
-            A = np.matmul(Omega_t, Omega)
-            # AI = np.linalg.inv(A)
-#             A = np.matmul(Omega_t, Omega)+1e-8*np.expand_dims(np.diag(np.ones(4)), axis=(0,1))
-            AI = np.linalg.pinv(A, hermitian=True)
-            B = np.matmul(Omega_t, Delta)
-            d_theta = np.matmul(AI, B)
-        
-            self.b0 += d_theta[:,:,0,0]
-            self.b1 += d_theta[:,:,1,0]
-            self.bN += d_theta[:,:,2,0]
-            self.phi1 += d_theta[:,:,3,0]
-            if self._c.debug:
-                print(f"\t\t The mean increasing amount of phi:{np.mean(np.abs(d_theta[:,:,3,0])):3g}")
+        update = self._update_ldl if self._c.lls_solver == "ldl" else self._update_pinv
+        valid = self.valid_pixels(images, moments, mask)
+        self._iterate(update, [self.b0, self.b1, self.bN, self.phi1], images, valid)
         return self.phi1, T1
     
-    def _func(self, alpha, delta, N):
-        img1 = self.b0+self.b1*np.cos(alpha*self.phi1+delta)
-        img2 = self.bN*np.cos(N*(alpha*self.phi1+delta))
+    def _update_ldl(self, theta, images):
+        """Accumulate the 10 unique entries of Omega^T*Omega and the 4 entries of
+        Omega^T*Delta image by image, then solve the 4x4 systems in closed form"""
+        b0, b1, bN, phi1 = theta
+        ws = lambda name, dtype=phi1.dtype: self._buffer(name, phi1.shape, dtype)
+        A = [ws(f"A{k}", self._acc_dtype()) for k in range(10)]
+        B = [ws(f"B{k}", self._acc_dtype()) for k in range(4)]
+        for x in A+B:
+            x.fill(0)
+        g3 = ws("grad_phi1", np.result_type(b1, bN, phi1))
+        for j, patterns in enumerate(images):
+            step = len(patterns)
+            N, alpha = step-1, self._c.alpha[j]
+            theta = np.multiply(alpha, phi1, out=ws("theta"))
+            sin_t, cos_t = np.sin(theta, out=ws("sin_t")), np.cos(theta, out=ws("cos_t"))
+            sin_tN, cos_tN = self._multiple_angle(sin_t, cos_t, N)
+            for img, (sin_z, cos_z), (sin_zN, cos_zN) in zip(patterns, 
+                    self._trig_steps("z", sin_t, cos_t, step), self._trig_steps("zN", sin_tN, cos_tN, step, N)):
+                # grad_phi1 = -alpha*(b1*sin_z+N*bN*sin_zN)
+                np.multiply(b1, sin_z, out=g3)
+                NbN = np.multiply(N, bN, out=ws("NbN", bN.dtype))
+                g3 += np.multiply(NbN, sin_zN, out=ws("tmp", np.result_type(NbN, sin_zN)))
+                np.multiply(-alpha, g3, out=g3)
+                grad = (1., cos_z, cos_zN, g3)
+                # delta = img-(b0+b1*cos_z+bN*cos_zN)
+                fit = ws("fit", np.result_type(b0, b1, bN, cos_z))
+                np.add(b0, np.multiply(b1, cos_z, out=ws("tmp", np.result_type(b1, cos_z))), out=fit)
+                fit += np.multiply(bN, cos_zN, out=ws("tmp", np.result_type(bN, cos_zN)))
+                delta = np.subtract(img, fit, out=ws("delta", np.result_type(img, fit)))
+                k = 0
+                for p in range(4):
+                    B[p] += delta if p == 0 else np.multiply(grad[p], delta, 
+                            out=ws("tmp", np.result_type(grad[p], delta)))
+                    for q in range(p, 4):
+                        A[k] += grad[q] if p == 0 else np.multiply(grad[p], grad[q], 
+                                out=ws("tmp", np.result_type(grad[p], grad[q])))
+                        k += 1
+        return solve_sym4(A, B, out=lambda name, dtype: ws(f"sym4_{name}", dtype))
+    
+    def _trig_steps(self, name, sin_t, cos_t, steps, k=1):
+        """sin/cos of k*zeta_s for every phase step s, by angle addition from sin/cos of k*theta,
+        computed in the workspace"""
+        ws = lambda n: self._buffer(n, sin_t.shape, sin_t.dtype)
+        sin_z, cos_z, tmp = ws(f"sin_{name}"), ws(f"cos_{name}"), ws(f"tmp_{name}")
+        for cd, sd in step_weights(steps, (k,)).T.tolist():
+            np.multiply(sin_t, cd, out=sin_z)
+            sin_z += np.multiply(cos_t, sd, out=tmp)
+            np.multiply(cos_t, cd, out=cos_z)
+            cos_z -= np.multiply(sin_t, sd, out=tmp)
+            yield sin_z, cos_z
+    
+    def _update_pinv(self, theta, images):
+        """The reference update: stacked Jacobian and a per-pixel pseudo-inverse"""
+        Omega, Delta = list(), list()
+        for j, patterns in enumerate(images):
+            step = len(patterns)
+            deltas = 2*np.pi*np.linspace(0, step-1, step)/step
+            alpha = self._c.alpha[j]
+            for s, img in enumerate(patterns):
+                img_fit = self._func(theta, alpha, deltas[s], step-1)
+                grad_theta = self._grad_func(theta, alpha, deltas[s], step-1)
+                grad_theta = np.stack(grad_theta, axis=-1)
+                Delta.append(img-img_fit)
+                Omega.append(grad_theta)
+                
+        Delta = np.stack(Delta, axis=-1)
+        Delta = np.expand_dims(Delta, axis=-1)
+        Omega = np.stack(Omega, axis=-2)
+        Omega_t = np.swapaxes(Omega,-1,-2)
+        
+        A = np.matmul(Omega_t, Omega)
+        # AI = np.linalg.inv(A)
+#         A = np.matmul(Omega_t, Omega)+1e-8*np.expand_dims(np.diag(np.ones(4)), axis=(0,1))
+        AI = np.linalg.pinv(A, hermitian=True)
+        B = np.matmul(Omega_t, Delta)
+        d_theta = np.matmul(AI, B)
+        return np.moveaxis(d_theta[...,0], -1, 0)
+    
+    def _func(self, theta, alpha, delta, N):
+        b0, b1, bN, phi1 = theta
+        img1 = b0+b1*np.cos(alpha*phi1+delta)
+        img2 = bN*np.cos(N*(alpha*phi1+delta))
         return img1+img2
 
-    def _grad_func(self, alpha, delta, N):
-        grad_phi1_p1 = -alpha*self.b1*np.sin(alpha*self.phi1+delta)
-        grad_phi1_p2 = - N*alpha*self.bN*np.sin(N*(alpha*self.phi1+delta))
+    def _grad_func(self, theta, alpha, delta, N):
+        b0, b1, bN, phi1 = theta
+        grad_phi1_p1 = -alpha*b1*np.sin(alpha*phi1+delta)
+        grad_phi1_p2 = - N*alpha*bN*np.sin(N*(alpha*phi1+delta))
         grad_phi1 = grad_phi1_p1+grad_phi1_p2
         
-        grad_b0 = np.ones_like(self.b0)
-        grad_b1 = np.cos(alpha*self.phi1+delta)
-        grad_bN = np.cos(N*(alpha*self.phi1+delta))
+        grad_b0 = np.ones_like(b0)
+        grad_b1 = np.cos(alpha*phi1+delta)
+        grad_bN = np.cos(N*(alpha*phi1+delta))
         return grad_b0, grad_b1, grad_bN, grad_phi1
     
-    def _init_param(self):
-        parttens = np.array(self.images)
-        self.b0 = np.mean(parttens, axis=(0,1)).astype(np.float32)
+    def _init_param(self, moments):
+        count = sum(len(imgs) for imgs in self.images)
+        self.b0 = (sum(imgs.sum(axis=0, dtype=np.float64) for imgs in self.images)/count).astype(self._phase_dtype())
         self.bN = np.zeros_like(self.b0)
         
         # self.b1
         step = len(self.images[0])
-        deltas = 2*np.pi*np.linspace(0, step-1, step)/step
-        part1, part2 = 0, 0
-        for s, img in enumerate(self.images[0]):
-            part1 += img*np.sin(deltas[s])
-            part2 += img*np.cos(deltas[s])
+        part2, part1 = moments[:2]
         self.b1 = np.sqrt(part1*part1+part2*part2)*2/step
 
 
 # our CFPE method
 class CFPE(PE):
+    halo = 2 # the 5x5 median filter of the initial phase
+
     def __init__(self, config):
         super(CFPE, self).__init__(config)
+        self.previous = None # the phase of the last scan, the seed of cfg.warm_start
         
-    def phase_extract(self, images):
-        self.phi1, T1 = self.basic_extract(images)
-        self.phi1 = cv2.medianBlur(self.phi1, 5)      
-        
-        for iter in range(self._c.MaxIter):
-            # if iter<self._c.MaxIter/2:
-                # self.phi1 = cv2.blur(self.phi1, (7,7))
-            c1, c2, c3, c4 = 0., 0., 0., 0.
-            Is, Ic, Ih = 0., 0., 0.
-            for f, imgs in enumerate(images):
-                steps = len(imgs)
-                alpha_f = self._c.alpha[f]
-                
-                for s, img in enumerate(imgs):
-                    zeta_s_f = alpha_f*self.phi1+2*np.pi*s/steps
-                    
-                    sin_zeta = np.sin(zeta_s_f)
-                    cos_zeta = np.cos(zeta_s_f)
-                    cos_zeta_h = np.cos((steps-1)*zeta_s_f)
-                    
-                    Is += sin_zeta*img
-                    Ic += cos_zeta*img
-                    Ih += cos_zeta_h*img
-                    
-                    c1 += sin_zeta**2
-                    c2 += sin_zeta*cos_zeta_h
-                    c3 += cos_zeta*cos_zeta_h
-                    c4 += cos_zeta_h**2
-
-            eps = 1e-6 # add eps to deal with pitfall points 
-            num = (c1*c4-c3*c3+eps)*Is + c2*c3*Ic -c1*c2*Ih
-            den = c2*c3*Is + (c1*c4-c2*c2+eps)*Ic -c1*c3*Ih
-            num[np.abs(num)<1e1] = 0.0
-            delta_phase = -np.arctan2(num, den)
-            self.phi1 += delta_phase 
-            if self._c.debug:
-                print(f"\t\t The mean increasing amount of phi:{np.mean(np.abs(delta_phase)):3g}")
+    def _extract(self, images, mask=None):
+        # image moments of every frequency, unchanged over the iterations
+        images = as_stack(images)
+        dtype = self._dtype(images)
+        moments = [self._moments(f, imgs, (1, len(imgs)-1), dtype) for f, imgs in enumerate(images)]
+        self.steps = [len(imgs) for imgs in images]
+        assert min(self.steps) >= 3
+        # a tile has no previous scan of its own
+        sequence = self._c.warm_start and not (self._c.tile_size or self._c.workers > 1)
+        warm = self._warm_seed(moments) if sequence else None
+        budget = None
+        if warm is None:
+            self.phi1, T1 = self.basic_extract(images, moments)
+            self.phi1 = self._median(self.phi1)
+        else:
+            self.phi1, fit, T1 = warm
+            budget = np.where(fit, self._c.warm_iter, self._c.MaxIter)
+            self.warm_fraction = fit.mean()
+        
+        self._iterate(self._update, [self.phi1], moments, self.valid_pixels(images, moments, mask), budget)
+        if sequence:
+            self.previous, self.T1 = self.phi1.copy(), T1
         return self.phi1, T1
+    
+    def _warm_seed(self, moments):
+        """The initial phase from the previous scan: moved onto the new wrapped phase of the first
+        frequency where it still fits the wrapped phases of every frequency within
+        cfg.warm_check (rad), elsewhere the scene changed and the phase is unwrapped anew, on
+        those pixels only, and median filtered. Returns (phi1, fit, T1), None without a
+        previous scan of the same size"""
+        prev = self.previous
+        if prev is None or prev.shape != moments[0].shape[1:]:
+            return None
+        fit = np.ones(prev.shape, bool)
+        psi = []
+        for f, m in enumerate(moments):
+            # psi_f = alpha_f*phi1 mod 2pi, the check of all frequencies also catches fringe order jumps
+            with profiler.stage("psi", pixels=prev.size):
+                psi.append(self.psi_extract(None, m))
+            d = np.mod(psi[f]-self._c.alpha[f]*prev+np.pi, 2*np.pi)-np.pi
+            fit &= np.abs(d) < self._c.warm_check
+            if f == 0:
+                seed = (prev+d).astype(prev.dtype)
+        
+        self.ambiguous = None
+        if not fit.all():
+            cold = ~fit
+            phi1, self.T1 = self.unwrap([p[cold] for p in psi])
+            seed[cold] = phi1
+            seed[cold] = self._median(seed)[cold]
+            if self.ambiguous is not None:
+                ambiguous, self.ambiguous = self.ambiguous, np.zeros(prev.shape, bool)
+                self.ambiguous[cold] = ambiguous
+        return seed, fit, self.T1
+    
+    def _update(self, theta, moments):
+        phi1, = theta
+        # if iter<self._c.MaxIter/2:
+            # self.phi1 = cv2.blur(self.phi1, (7,7))
+        # all the arrays live in the workspace, t: dtype of the phase, a: of the image sums
+        t, a = phi1.dtype, np.result_type(phi1, moments[0])
+        ws = lambda name, dtype: self._buffer(name, phi1.shape, dtype)
+        Is, Ic, Ih, tmp, tmp2 = (ws(name, a) for name in ("Is", "Ic", "Ih", "tmp", "tmp2"))
+        c2, c3, tp, tp2 = (ws(name, t) for name in ("c2", "c3", "tp", "tp2"))
+        for x in (Is, Ic, Ih, c2, c3):
+            x.fill(0)
+        c1, c4 = 0., 0.
+        for f, (mc1, ms1, mcN, msN) in enumerate(moments):
+            steps = self.steps[f]
+            
+            theta = np.multiply(self._c.alpha[f], phi1, out=ws("theta", t))
+            sin_t, cos_t = np.sin(theta, out=ws("sin_t", t)), np.cos(theta, out=ws("cos_t", t))
+            sin_tN, cos_tN = self._multiple_angle(sin_t, cos_t, steps-1)
+            
+            # sum_s {sin, cos, cos_h}(zeta_s)*img_s, by angle addition
+            # Is += sin_t*mc1 + cos_t*ms1
+            np.multiply(sin_t, mc1, out=tmp)
+            tmp += np.multiply(cos_t, ms1, out=tmp2)
+            Is += tmp
+            # Ic += cos_t*mc1 - sin_t*ms1
+            np.multiply(cos_t, mc1, out=tmp)
+            tmp -= np.multiply(sin_t, ms1, out=tmp2)
+            Ic += tmp
+            # Ih += cos_tN*mcN - sin_tN*msN
+            np.multiply(cos_tN, mcN, out=tmp)
+            tmp -= np.multiply(sin_tN, msN, out=tmp2)
+            Ih += tmp
+            
+            # sum_s of the products; by product-to-sum only the steps*theta terms survive
+            # c2 += steps/2*(sin_tN*cos_t + cos_tN*sin_t)
+            np.multiply(sin_tN, cos_t, out=tp)
+            tp += np.multiply(cos_tN, sin_t, out=tp2)
+            tp *= steps/2
+            c2 += tp
+            # c3 += steps/2*(cos_tN*cos_t - sin_tN*sin_t)
+            np.multiply(cos_tN, cos_t, out=tp)
+            tp -= np.multiply(sin_tN, sin_t, out=tp2)
+            tp *= steps/2
+            c3 += tp
+            c1 += steps/2
+            c4 += steps/2
+
+        eps = 1e-6 # add eps to deal with pitfall points 
+        # num = (c1*c4-c3*c3+eps)*Is + c2*c3*Ic -c1*c2*Ih
+        num = ws("num", a)
+        np.subtract(c1*c4, np.multiply(c3, c3, out=tp), out=tp)
+        tp += eps
+        np.multiply(tp, Is, out=num)
+        num += np.multiply(np.multiply(c2, c3, out=tp), Ic, out=tmp)
+        num -= np.multiply(np.multiply(c1, c2, out=tp), Ih, out=tmp)
+        # den = c2*c3*Is + (c1*c4-c2*c2+eps)*Ic -c1*c3*Ih
+        den = ws("den", a)
+        np.multiply(np.multiply(c2, c3, out=tp), Is, out=den)
+        np.subtract(c1*c4, np.multiply(c2, c2, out=tp), out=tp)
+        tp += eps
+        den += np.multiply(tp, Ic, out=tmp)
+        den -= np.multiply(np.multiply(c1, c3, out=tp), Ih, out=tmp)
+        
+        # num[np.abs(num)<1e1] = 0.0
+        np.copyto(num, 0.0, where=np.less(np.abs(num, out=tmp), 1e1, out=ws("mask", bool)))
+        delta_phase = np.arctan2(num, den, out=ws("delta_phase", a))
+        return np.negative(delta_phase, out=delta_phase),
 
 
 # multifrequency phase extraction (MPE) method 
 # an ablation method of our CFPE
 class MPE(PE):
+    halo = 2 # the 5x5 median filter of the initial phase
+
     def __init__(self, config):
         super(MPE, self).__init__(config)
         
-    def phase_extract(self, images):
-        self.phi1, T1 = self.basic_extract(images)  
-        self.phi1 = cv2.medianBlur(self.phi1, 5)  
+    def _extract(self, images, mask=None):
+        images = as_stack(images)
+        dtype = self._dtype(images)
+        moments = [self._moments(f, imgs, dtype=dtype) for f, imgs in enumerate(images)]
+        self.phi1, T1 = self.basic_extract(images, moments)  
+        self.phi1 = self._median(self.phi1)
             
-        for it in range(self._c.MaxIter):
-            Is, Ic = 0, 0
-            for f, imgs in enumerate(images):
-                steps = len(imgs)
-                alpha_f = self._c.alpha[f]
-                for s, img in enumerate(imgs):
-                    zeta_s_f = alpha_f*self.phi1+2*np.pi*s/steps
-                    Is += np.sin(zeta_s_f)*img
-                    Ic += np.cos(zeta_s_f)*img
-
-            delta_phase = -np.arctan2(Is, Ic)
-            self.phi1 += delta_phase 
-            if self._c.debug:
-                print(f"\t\t The mean increasing amount of phi:{np.mean(np.abs(delta_phase)):3g}")
+        self._iterate(self._update, [self.phi1], moments, self.valid_pixels(images, moments, mask))
         return self.phi1, T1
+    
+    def _update(self, theta, moments):
+        phi1, = theta
+        t, a = phi1.dtype, np.result_type(phi1, moments[0])
+        ws = lambda name, dtype: self._buffer(name, phi1.shape, dtype)
+        Is, Ic, tmp, tmp2 = (ws(name, a) for name in ("Is", "Ic", "tmp", "tmp2"))
+        Is.fill(0)
+        Ic.fill(0)
+        for f, (mc, ms) in enumerate(moments):
+            theta = np.multiply(self._c.alpha[f], phi1, out=ws("theta", t))
+            sin_t, cos_t = np.sin(theta, out=ws("sin_t", t)), np.cos(theta, out=ws("cos_t", t))
+            # Is += sin_t*mc + cos_t*ms
+            np.multiply(sin_t, mc, out=tmp)
+            tmp += np.multiply(cos_t, ms, out=tmp2)
+            Is += tmp
+            # Ic += cos_t*mc - sin_t*ms
+            np.multiply(cos_t, mc, out=tmp)
+            tmp -= np.multiply(sin_t, ms, out=tmp2)
+            Ic += tmp
+
+        delta_phase = np.arctan2(Is, Ic, out=ws("delta_phase", a))
+        return np.negative(delta_phase, out=delta_phase),
+
+# sliding-window extraction of a cyclically projected sequence
+class StreamPE():
+    """Frame k of the stream is step s of frequency f, (f, s) = slots[k % len(slots)] in the
+    order of the projector (the fringes only). The first-order moments of the last full cycle
+    are running sums: a new frame replaces the contribution of the frame of its slot one cycle
+    earlier, and only the psi of its frequency is recomputed before the unwrapping. So after
+    the first cycle every frame gives a phase map for the work of one frame. Every
+    cfg.stream_refresh cycles the sums are recomputed from the window, which bounds the
+    rounding drift of the running updates."""
+    def __init__(self, config, pe=None):
+        self._c = config
+        self.pe = PE(config) if pe is None else pe
+        self.slots = [(f, s) for f, S in enumerate(config.steps) for s in range(S)]
+        self.reset()
+    
+    def reset(self):
+        self.window, self.moments, self.psi = None, None, None
+        self.count = 0
+    
+    def push(self, frame, mask=None):
+        """Add the next frame. Returns (phase, T1) of the last full cycle as phase_extract()
+        does, None until the first cycle is complete"""
+        frame = np.asarray(frame)
+        f, s = self.slots[self.count % len(self.slots)]
+        if self.window is None:
+            self.window = [np.zeros((S,)+frame.shape, frame.dtype) for S in self._c.steps]
+            self.moments = [np.zeros((2,)+frame.shape, self.pe._acc_dtype()) for S in self._c.steps]
+            self.psi = [None]*len(self._c.steps)
+        
+        m, old = self.moments[f], self.window[f][s]
+        with profiler.stage("stream_update", pixels=frame.size):
+            # m += w_s*(frame-old), w_s the weights of step s
+            diff = np.subtract(frame, old, out=self.pe._buffer("stream_diff", frame.shape, m.dtype), dtype=m.dtype)
+            tmp = self.pe._buffer("stream_tmp", frame.shape, m.dtype)
+            for mk, wk in zip(m, step_weights(len(self.window[f]))[:, s].tolist()):
+                mk += np.multiply(diff, wk, out=tmp)
+            old[...] = frame
+        self.count += 1
+        if self.count % (len(self.slots)*self._c.stream_refresh) == 0:
+            self.refresh()
+        if self.count < len(self.slots):
+            return None
+        
+        for k, psi in enumerate(self.psi):
+            if k == f or psi is None:
+                with profiler.stage("psi", pixels=frame.size):
+                    # psi in the dtype of the batch moments, the unwrapping runs at that precision
+                    psi = self.pe.psi_extract(None, self.moments[k])
+                    self.psi[k] = psi.astype(self.pe._dtype(self.window), copy=False)
+        phase, T1 = self.pe.unwrap(self.psi)
+        valid = self.pe.valid_pixels(self.window, self.moments, mask)
+        if valid is not None:
+            phase[~valid] = np.nan
+        return phase, T1
+    
+    def refresh(self):
+        """Recompute the running sums from the window"""
+        self.moments = [step_moments(imgs, dtype=m.dtype) for imgs, m in zip(self.window, self.moments)]
+        self.psi = [None]*len(self.psi)
+
 
 def phase_wrapper(cfg, method):
     assert method in ["PE","LLS","CFPE","MPE"]
     return eval(method)(cfg)
+
+
+def precision_report(cfg, methods=("PE","MPE","LLS","CFPE"), noise_models=("gamma","harmonic","seg"),
+                     policies=("float32","mixed"), size=(512,128)):
+    """The phase RMSE (rad) of each precision policy against the float64 path, on 8-bit
+    synthetic fringes of fringes.py"""
+    from fringes import fringe_wrapper
+    cfg = type(cfg)(cfg)
+    cfg.pattern_size, cfg.debug = list(size), False
+    
+    report = dict()
+    for model in noise_models:
+        images = np.array(fringe_wrapper(cfg, model).generate_all())
+        images = np.clip(np.round(images), 0, 255).astype(np.uint8)
+        for method in methods:
+            cfg.precision = "float64"
+            phase_ref, _ = phase_wrapper(cfg, method).phase_extract(images)
+            for policy in policies:
+                cfg.precision = policy
+                phase, _ = phase_wrapper(cfg, method).phase_extract(images)
+                report[model, method, policy] = np.sqrt(np.nanmean((phase-phase_ref)**2))
+                print(f"{model:>8s}, {method:>5s}, {policy:>8s}: RMSE {report[model, method, policy]:.3g}")
+    return report
@@ -0,0 +1,127 @@
+"""
+Stage instrumentation of the pipeline
+    from profiler import profiler, Collector
+    stages = Collector()
+    profiler.add_sink(stages)  # or any callable(record), or JsonLines("stages.jsonl")
+    ...
+    stages.report()
+
+The pipeline wraps its stages (image load, moments, psi, unwrap, median, iteration, remap,
+disparity, reproject, export) in profiler.stage(name, **info), each emits one record
+dict(stage, start, seconds, thread, **info) to every sink, info e.g. pixels and nbytes,
+step the mean phase increment of an iteration.
+Without a sink stage() returns a shared no-op context, the disabled cost is one call.
+"""
+import json
+import threading
+import time
+
+import numpy as np
+
+
+class Stage():
+    """A timed stage, add() attaches info known only at its end, e.g. the nbytes of a result"""
+    __slots__ = ("profiler", "info", "start")
+
+    def __init__(self, profiler, name, info):
+        self.profiler = profiler
+        self.info = dict(stage=name, **info)
+
+    def add(self, **info):
+        self.info.update(info)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter()-self.start
+        self.profiler.emit(dict(self.info, start=self.start, seconds=seconds, thread=threading.get_ident()))
+        return False
+
+
+class NullStage():
+    """The stage of a disabled profiler"""
+    def add(self, **info):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null = NullStage()
+
+
+class Profiler():
+    def __init__(self):
+        self.sinks = []
+
+    @property
+    def enabled(self):
+        return bool(self.sinks)
+
+    def add_sink(self, sink):
+        """sink: callable(record), e.g. a Collector or JsonLines"""
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def stage(self, name, **info):
+        return Stage(self, name, info) if self.sinks else _null
+
+    def emit(self, record):
+        for sink in self.sinks:
+            sink(record)
+
+
+class Collector():
+    """The records in memory, with their per-stage summary"""
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def clear(self):
+        self.records = []
+
+    def summary(self):
+        """Per stage: the count, total, mean and max seconds, and the pixels and nbytes of all calls"""
+        stages = dict()
+        for r in self.records:
+            stages.setdefault(r["stage"], []).append(r)
+        summary = dict()
+        for name, rs in stages.items():
+            t = np.array([r["seconds"] for r in rs])
+            summary[name] = dict(count=len(rs), total=t.sum(), mean=t.mean(), max=t.max(),
+                    pixels=sum(r.get("pixels", 0) for r in rs), nbytes=sum(r.get("nbytes", 0) for r in rs))
+        return summary
+
+    def report(self):
+        for name, s in self.summary().items():
+            print(f"{name:>13}: {s['count']:5d} x {s['mean']*1e3:8.2f} ms = {s['total']:7.3f} s, "
+                  f"max {s['max']*1e3:8.2f} ms, {s['pixels']/1e6:8.2f} MP, {s['nbytes']/2**20:8.1f} MB")
+
+
+class JsonLines():
+    """The records appended to fn, one JSON object per line"""
+    def __init__(self, fn):
+        self.file = open(fn, "a")
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record)+"\n"
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        self.file.close()
+
+
+# the process-wide profiler of the pipeline, disabled until a sink is added
+profiler = Profiler()
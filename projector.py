@@ -4,10 +4,14 @@ import numpy as np
 from pathlib import Path
 import pygame
 
+from fringes import pattern_bank
+
 
 class Projector():
-    def __init__(self, cfg):
+    def __init__(self, cfg, bank=None):
+        """bank: the PatternBank to project, by default the cached one of cfg"""
         self._c = cfg
+        self.bank = bank
         # initial the pygame settings
         pygame.init()
         self.wait_proj = True
@@ -28,6 +32,12 @@ class Projector():
 
         self.counter_h, self.counter_v = 0, 0
 
+        if self._c.pattern_source == "bank":
+            bank = self.bank if self.bank is not None else pattern_bank(self._c)
+            self.images_h = [self._surface(img) for img in bank.frames["h"]]
+            self.images_v = [self._surface(img) for img in bank.frames["v"]]
+            return
+
         root = self._c.pattern_path
         for f, T in enumerate(self._c.Tp):
             for s in range(self._c.steps[f]):
@@ -39,6 +49,11 @@ class Projector():
         img_bg = Path(root)/f"bg.bmp" 
         self.images_h.append(pygame.image.load(img_bg).convert())
 
+    def _surface(self, img):
+        H, W = img.shape
+        rgb = np.repeat(img[..., None], 3, axis=-1)
+        return pygame.image.frombuffer(rgb.tobytes(), (W, H), "RGB").convert()
+
     def wait_to_begin(self):
         self.screen.blit(self.bg,(0,0))
         pygame.display.flip()
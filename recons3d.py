@@ -1,10 +1,14 @@
 import numpy as np
 import cv2
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import matplotlib.pyplot as plt
 
-from phase import *
+from phase import phase_wrapper
 from calibration import Calibrator
+from profiler import profiler
+from scans import ScanFile, recorded_scans, recorded_steps, recording_files
 
 
 ply_header = '''ply
@@ -17,37 +21,193 @@ end_header
 '''
 
 
+def write_ply(fn, points, gray=None, mask=None, chunk=1<<20):
+    """Write the (..., 3) points of reprojectImageTo3D as a binary little-endian PLY, with the
+    uint8 gray of the same (...) shape as a per-vertex property if given. Only the points in mask,
+    by default the finite ones, are written; they are streamed chunk points at a time, so at most
+    one chunk is ever compacted. Without gray and with every point valid it is a single tofile()"""
+    with profiler.stage("export", pixels=points.size//3) as stage:
+        nbytes = _write_ply(fn, points.reshape(-1, 3), gray, mask, chunk)
+        stage.add(nbytes=nbytes)
+
+
+def _write_ply(fn, points, gray, mask, chunk):
+    mask = np.isfinite(points).all(axis=-1) if mask is None else np.ravel(mask)
+    gray = None if gray is None else np.ravel(gray)
+    
+    props = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {np.count_nonzero(mask)}"]
+    header += ["property float x", "property float y", "property float z"]
+    if gray is not None:
+        props.append(("gray", "u1"))
+        header.append("property uchar gray")
+    header.append("end_header\n")
+    
+    with open(fn, 'wb') as f:
+        f.write("\n".join(header).encode('ascii'))
+        if gray is None and mask.all():
+            points.astype("<f4", copy=False).tofile(f)
+            return f.tell()
+        vertex = np.dtype(props)
+        for i in range(0, len(points), chunk):
+            m = mask[i:i+chunk]
+            verts = np.empty(np.count_nonzero(m), vertex)
+            xyz = points[i:i+chunk][m]
+            verts["x"], verts["y"], verts["z"] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+            if gray is not None:
+                verts["gray"] = gray[i:i+chunk][m]
+            verts.tofile(f)
+        return f.tell()
+
+
+def inverse_phase_table(phase_rectified, bins=None):
+    """The inverse of each row of the rectified reference phase: the column where the row
+    crosses each level p0+k*dp, k<bins, of a regular phase grid. A level that is not crossed
+    exactly once, and upwards, has no unique column (out of range, or the row is not monotonic
+    there) and is NaN. The zeros that cv2.remap leaves outside the projector are no crossings.
+    Returns (table, p0, dp), table of shape (H, bins)"""
+    H, W = phase_rectified.shape
+    bins = 4*W if bins is None else bins
+    p = phase_rectified.astype(np.float64)
+    # inside the projector, away from the pixels that cv2.remap blends with the zero border
+    valid = p > 0
+    valid[:, 1:-1] &= valid[:, :-2] & valid[:, 2:]
+    p0, dp = float(p[valid].min()), float(p[valid].max()-p[valid].min())/(bins-1)
+    levels = p0+dp*np.arange(bins)
+    
+    # the segment (c, c+1) crosses the levels k in [ceil((min-p0)/dp), ceil((max-p0)/dp))
+    a, b = p[:, :-1], p[:, 1:]
+    segment = valid[:, :-1] & valid[:, 1:]
+    lo = np.ceil((np.minimum(a, b)-p0)/dp).astype(np.intp)
+    hi = np.ceil((np.maximum(a, b)-p0)/dp).astype(np.intp)
+    rows = np.broadcast_to(np.arange(H)[:, None], lo.shape)
+    crossings = list()
+    for direction in (segment & (b > a), segment & (b < a)):
+        count = np.zeros((H, bins+1), np.int32)
+        np.add.at(count, (rows[direction], lo[direction].clip(0, bins)), 1)
+        np.add.at(count, (rows[direction], hi[direction].clip(0, bins)), -1)
+        crossings.append(np.cumsum(count, axis=1)[:, :bins])
+    up, down = crossings
+    
+    # where the crossing is unique, the running maximum of the row crosses the level there too
+    table = np.full((H, bins), np.nan)
+    for v in range(H):
+        cols = np.flatnonzero(valid[v])
+        if len(cols) > 1:
+            table[v] = np.interp(levels, np.maximum.accumulate(p[v, cols]), cols)
+    table[(up != 1) | (down != 0)] = np.nan
+    return table.astype(np.float32), p0, dp
+
+
 class Recons3D():
     def __init__(self, cfg):
         self._c = cfg
         self.calibrator = Calibrator(self._c)
-        self.map_c1, self.map_c2, self.phase_rectified, self.Q = self.calibrator.load()
-
-        self.pe = eval(self._c.pe_method)(self._c)
+        self.pe = phase_wrapper(self._c, self._c.pe_method)
+        self.scan_files = dict()
+        
+        if self._c.calibra_artifact:
+            self.load_artifact()
+        else:
+            self.map_c1, self.map_c2, self.phase_rectified, self.Q = self.calibrator.load()
+            self.roi = self.camera_roi()
+            if self._c.disp_method == "lookup":
+                self.table, self.p0, self.dp = inverse_phase_table(self.phase_rectified)
+        if self._c.debug and self._c.disp_method == "lookup":
+            print(f"phase levels without a unique column: {np.isnan(self.table).mean():.2%}")
         
         self.shape = self.phase_rectified.shape
+        s_x, s_y = np.meshgrid(np.arange(self.shape[1]), np.arange(self.shape[0]))
+        self.s_x, self.s_y = s_x.astype(np.float32), s_y.astype(np.float32)
+        # per rectified row the lowest and highest camera row it samples, per column the columns
+        xs, ys = self.map_c1[..., 0], self.map_c1[..., 1]
+        self.source_rows, self.source_cols = (ys.min(1), ys.max(1)), (xs.min(0), xs.max(0))
 
+    artifact = ("map_c1", "map_c2", "phase_rectified", "Q", "roi", "table", "p0_dp")
+    
+    def load_artifact(self):
+        """The calibration and its derived tables, memory-mapped from the uncompressed .npy files
+        of the artifact folder in calibra_path. The folder is (re)built from
+        calibration_result.npz when that changed; the remap maps keep the fixed-point CV_16SC2
+        form of the calibration, the fastest for cv2.remap"""
+        root = Path(self._c.calibra_path)
+        folder = root/self._c.calibra_artifact
+        st = os.stat(root/"calibration_result.npz")
+        stamp = np.array([st.st_size, st.st_mtime_ns])
+        try:
+            fresh = np.array_equal(np.load(folder/"stamp.npy"), stamp)
+        except (OSError, ValueError):
+            fresh = False
+        if not fresh:
+            self.save_artifact(folder, stamp)
         
-    def measure(self, images, gray):
-        phase, _ = self.pe.phase_extract(images)
-        phase = cv2.remap(phase, self.map_c1, self.map_c2, cv2.INTER_LINEAR)
-        
-        gray = cv2.remap(gray, self.map_c1, self.map_c2, cv2.INTER_CUBIC)
+        data = {name: np.load(folder/f"{name}.npy", mmap_mode="r") for name in self.artifact}
+        self.map_c1, self.map_c2, self.phase_rectified, self.Q = (data[k] for k in self.artifact[:4])
+        self.roi, self.table = data["roi"], data["table"]
+        self.p0, self.dp = data["p0_dp"].tolist()
+    
+    def save_artifact(self, folder, stamp):
+        folder.mkdir(parents=True, exist_ok=True)
+        self.map_c1, self.map_c2, self.phase_rectified, self.Q = self.calibrator.load()
+        table, p0, dp = inverse_phase_table(self.phase_rectified)
+        arrays = (self.map_c1, self.map_c2, self.phase_rectified, self.Q, self.camera_roi(), table, [p0, dp])
+        # every file through a rename, the stamp last, for the workers starting concurrently
+        for name, x in list(zip(self.artifact, arrays))+[("stamp", stamp)]:
+            tmp = folder/f"{name}.{os.getpid()}.tmp.npy"
+            np.save(tmp, np.ascontiguousarray(x))
+            os.replace(tmp, folder/f"{name}.npy")
+
+    def camera_roi(self):
+        """The camera pixels that the rectification samples, with the 4x4 support of INTER_CUBIC"""
+        W, H = self._c.img_sz
+        roi = np.zeros((H, W), np.uint8)
+        xs, ys = self.map_c1[..., 0].ravel(), self.map_c1[..., 1].ravel()
+        inside = (xs >= 0) & (xs < W) & (ys >= 0) & (ys < H)
+        roi[ys[inside], xs[inside]] = 1
+        return cv2.dilate(roi, np.ones((5, 5), np.uint8)) > 0
+    
+    def rectified_box(self, mask):
+        """The (rows, cols) slices of the rectified frame that sample the camera pixels of mask,
+        with the 4x4 support of INTER_CUBIC; the whole frame for no mask"""
+        H, W = self.shape
+        if mask is None or not mask.any():
+            return slice(0, H), slice(0, W)
+        ys, xs = np.flatnonzero(mask.any(1)), np.flatnonzero(mask.any(0))
+        box = list()
+        for (lo, hi), s in zip((self.source_rows, self.source_cols), (ys, xs)):
+            # the source pixel f is sampled with f-1..f+2
+            inside = np.flatnonzero((hi >= s[0]-2) & (lo <= s[-1]+1))
+            if len(inside) == 0:
+                return slice(0, H), slice(0, W)
+            box.append(slice(int(inside[0]), int(inside[-1])+1))
+        return tuple(box)
+    
+    def measure(self, images, gray, debug=None):
+        """The rectified phase and the points of one scan. debug: the plots and prints of this
+        scan, cfg.debug by default"""
+        debug = self._c.debug if debug is None else debug
+        # extract the phase only where it survives the masks below, dilated for the remaps
+        mask = None
+        if self._c.pe_mask:
+            bright = cv2.dilate((gray >= 35).astype(np.uint8), np.ones((5, 5), np.uint8)) > 0
+            mask = self.roi & bright
+        phase, _ = self.pe.phase_extract(images, mask, debug)
+        # the lookup solves pixel by pixel, remap and solve only the rectified box of the mask
+        box = self.rectified_box(mask if self._c.disp_method == "lookup" else None)
+        phase_c, gray_c = phase, gray
+        phase, gray = np.full(self.shape, np.nan, phase_c.dtype), np.zeros(self.shape, gray_c.dtype)
+        with profiler.stage("remap", pixels=phase[box].size):
+            maps = np.ascontiguousarray(self.map_c1[box]), np.ascontiguousarray(self.map_c2[box])
+            phase[box] = cv2.remap(phase_c, *maps, cv2.INTER_LINEAR)
+            gray[box] = cv2.remap(gray_c, *maps, cv2.INTER_CUBIC)
         gray_mask = gray<35
         
-        s_x, s_y = np.meshgrid(np.arange(self.shape[1]), np.arange(self.shape[0]))
-        s_x, s_y = s_x.astype(np.float32), s_y.astype(np.float32)
-        x = np.zeros_like(self.phase_rectified).astype(np.float32)
-        
-        alpha = 0.9
-        for i in range(10):
-            alpha *= 0.9
-            wp = cv2.remap(self.phase_rectified, s_x-x, s_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
-            diff = wp-phase
-            if i<5:
-                diff = cv2.blur(diff, (3,3))
-            x = x + alpha*diff.astype(np.float32)
-        disp = x
+        with profiler.stage("disparity", pixels=phase[box].size, method=self._c.disp_method):
+            if self._c.disp_method == "lookup":
+                disp = np.full(self.shape, np.nan, np.float32)
+                disp[box] = self.disparity_lookup(phase[box], debug, box)
+            else:
+                disp = self.disparity_iterative(phase)
           
         mask = disp< -50
         disp[mask]= np.nan
@@ -55,10 +215,13 @@ class Recons3D():
         disp[mask]= np.nan
         disp[gray_mask]= np.nan
             
-        self.points = cv2.reprojectImageTo3D(disp.astype(np.float32), self.Q)
+        with profiler.stage("reproject", pixels=disp.size) as stage:
+            self.points = cv2.reprojectImageTo3D(disp.astype(np.float32), self.Q)
+            stage.add(nbytes=self.points.nbytes)
         # self.points = self.points[45:-35, 40:-5,:]
         
-        if self._c.debug:
+        if debug:
+            import matplotlib.pyplot as plt
             plt.figure(figsize=(16,6))
             plt.subplot(1,2,1)
             plt.imshow(phase)
@@ -75,10 +238,130 @@ class Recons3D():
             plt.title("disparity")
         return phase, self.points
 
+    def disparity_iterative(self, phase):
+        """solve phase_rectified(x-disp) = phase by a damped fixed-point iteration"""
+        s_x, s_y = self.s_x, self.s_y
+        x = np.zeros_like(self.phase_rectified).astype(np.float32)
+        
+        alpha = 0.9
+        for i in range(10):
+            alpha *= 0.9
+            wp = cv2.remap(self.phase_rectified, s_x-x, s_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            diff = wp-phase
+            diff[np.isnan(diff)] = 0 # the pixels left out of the phase extraction
+            if i<5:
+                diff = cv2.blur(diff, (3,3))
+            x = x + alpha*diff.astype(np.float32)
+        x[np.isnan(phase)] = np.nan
+        return x
+    
+    def disparity_lookup(self, phase, debug=None, box=None):
+        """solve phase_rectified(x-disp) = phase by interpolating the inverse_phase_table() of the
+        row. phase: the whole rectified frame, or its (rows, cols) slices box. self.unresolved
+        marks the pixels with a phase but no unique reference column"""
+        rows, cols = (slice(None), slice(None)) if box is None else box
+        table, s_x = self.table[rows], self.s_x[rows, cols]
+        H, bins = table.shape
+        t = (phase-self.p0)*(1/self.dp)
+        inside = (t >= 0) & (t < bins-1)
+        t[~inside] = 0
+        k = t.astype(np.intp)
+        w = (t-k).astype(np.float32)
+        k += bins*np.arange(H)[:, None]
+        col = table.take(k)*(1-w) + table.take(k+1)*w
+        col[~inside] = np.nan
+        disp = s_x-col
+        
+        self.unresolved = np.isnan(disp) & np.isfinite(phase)
+        if self._c.debug if debug is None else debug:
+            print(f"pixels without a unique reference column: {self.unresolved.mean():.2%}")
+        return disp
+
+    def read_scan(self, root, case):
+        """The fringe images, a list (frequencies) of (steps, H, W) arrays, and the gray image of
+        scan case under root, as Capture.measure_capture records them: {case}{i:02d}h.bmp, the
+        fringes frequency by frequency, then the gray, or from the container cfg.measure_scans
+        under root, laid out as its header steps. Recordings with more steps per frequency
+        (cfg.record_steps, or inferred from the number of frames) are subsampled to cfg.steps,
+        as in Exp2; from the container the images are views of its memmap whenever the
+        subsampling is regular"""
+        steps = self._c.steps
+        with profiler.stage("load") as stage:
+            if self._c.measure_scans:
+                scan = self.scan_file(Path(root)/self._c.measure_scans).get(case)
+                if scan.periods != [float(T) for T in self._c.Tc]:
+                    raise ValueError(f"scan {case} has the periods {scan.periods}, not cfg.Tc {self._c.Tc}")
+                recorded = scan.steps
+            else:
+                files = recording_files(root, case)
+                recorded = recorded_steps(len(files), self._c)
+            if len(recorded) != len(steps) or any(R < S for R, S in zip(recorded, steps)):
+                raise ValueError(f"scan {case} has {recorded} steps, fewer than cfg.steps {steps}")
+            # the steps kept of each frequency
+            index = [slice(0, R, R//S) if R % S == 0 else [s*R//S for s in range(S)] for R, S in zip(recorded, steps)]
+            if self._c.measure_scans:
+                images, gray = [imgs[ix] for imgs, ix in zip(scan.images(), index)], scan.extras[0]
+            else:
+                read = lambda i: cv2.imread(str(files[i]), 0)
+                starts = np.cumsum([0]+recorded).tolist()
+                images = [np.stack([read(start+i) for i in np.arange(R)[ix]]) 
+                          for start, R, ix in zip(starts, recorded, index)]
+                gray = read(starts[-1])
+            if self._c.record_gamma:
+                lut = (np.power(np.arange(256)/255., self._c.record_gamma)*255).astype(np.float32)
+                images = [lut.take(imgs) for imgs in images]
+            stage.add(pixels=gray.size*(sum(steps)+1), nbytes=sum(imgs.nbytes for imgs in images))
+        return images, gray
+    
+    def scan_file(self, path):
+        """The ScanFile of path, mapped once per Recons3D"""
+        if path not in self.scan_files:
+            self.scan_files[path] = ScanFile(path)
+        return self.scan_files[path]
+    
+    def measure_batch(self, scans=None, out=None):
+        """Reconstruct many recorded scans, scans: the cases under cfg.measure_path, a folder of
+        them, or None for all of cfg.measure_path. The next cfg.batch_prefetch scans are decoded
+        in a thread pool while the current one is reconstructed by this extractor, with its
+        workspace and the rectification tables, and a writer thread saves the points to
+        out/{case}.ply (by default the folder "points" of the scans), without the debug plots
+        and prints of measure. Returns the files written"""
+        root = Path(self._c.measure_path)
+        if scans is None or isinstance(scans, (str, Path)):
+            root = root if scans is None else Path(scans)
+            scans = recorded_scans(root, self._c.measure_scans)
+        scans = [case if isinstance(case, str) else f"{case:0>2d}" for case in scans]
+        out = root/"points" if out is None else Path(out)
+        out.mkdir(parents=True, exist_ok=True)
+        
+        prefetch = self._c.batch_prefetch
+        files, writes = [], deque()
+        with ThreadPoolExecutor(self._c.batch_workers) as readers, ThreadPoolExecutor(1) as writer:
+            reads = deque(readers.submit(self.read_scan, root, case) for case in scans[:prefetch+1])
+            ahead = iter(scans[prefetch+1:])
+            for case in scans:
+                images, gray = reads.popleft().result()
+                case_next = next(ahead, None)
+                if case_next is not None:
+                    reads.append(readers.submit(self.read_scan, root, case_next))
+                _, points = self.measure(images, gray, debug=False)
+                
+                files.append(out/f"{case}.ply")
+                writes.append(writer.submit(write_ply, files[-1], points))
+                while len(writes) > prefetch: # bound the points waiting to be written
+                    writes.popleft().result()
+            for w in writes:
+                w.result()
+        return files
+
     def remap(self, img):
         return cv2.remap(img, self.map_c1, self.map_c2, cv2.INTER_CUBIC)
 
-    def save_points(self, fn, points=None):
+    def save_points(self, fn, points=None, gray=None, binary=True):
+        """binary: write_ply() with the optional per-vertex gray, else the ASCII PLY"""
+        if binary:
+            write_ply(fn, self.points if points is None else points, gray)
+            return
         # if points is not None
             # verts = points 
         # else: 
@@ -88,6 +371,6 @@ class Recons3D():
         mask = ~np.isnan(np.sum(verts, axis=-1))
         verts = verts[mask]
         # verts[np.isnan(verts)] = 0.00
-        with open(fn, 'wb') as f:
+        with profiler.stage("export", pixels=len(verts)), open(fn, 'wb') as f:
             f.write((ply_header % dict(vert_num=len(verts))).encode('utf-8'))
             np.savetxt(f, verts, fmt='%f %f %f')
\ No newline at end of file
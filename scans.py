@@ -0,0 +1,174 @@
+"""
+A packed container of fringe scans, any number of scans appended in one file
+    python scans.py recordings <measure_path> [out.scan]
+    python scans.py calibration <calibra_path> [out.scan]
+
+A record is MAGIC, the uint32 length of a JSON header, the header, zero padding to a
+multiple of ALIGN bytes, then its frames as one uncompressed (N, H, W) uint8 block: the
+fringes frequency by frequency (header steps) followed by the extra frames, e.g. the gray
+image. The header keeps name, hv, shape, steps, periods and the capture metadata. The whole
+file is mapped once with np.memmap, every frame is a zero-copy view of it.
+"""
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import cv2
+
+
+MAGIC = b"CFPESCAN"
+ALIGN = 64
+
+
+def write_scan(f, name, frames, steps, periods, hv="h", **meta):
+    """Append one record to the binary file f: frames, (N, H, W) uint8, the sum(steps) fringes
+    and then the extra frames"""
+    frames = np.ascontiguousarray(frames)
+    assert frames.dtype == np.uint8 and frames.ndim == 3 and len(frames) >= sum(steps)
+    header = dict(name=name, hv=hv, shape=list(frames.shape), steps=[int(s) for s in steps],
+                  periods=[float(T) for T in periods], meta=meta)
+    header = json.dumps(header).encode()
+    pad = -(f.tell()+len(MAGIC)+4+len(header)) % ALIGN
+    f.write(MAGIC+np.array(len(header), "<u4").tobytes()+header+bytes(pad))
+    f.write(frames.data)
+
+
+def append_scan(path, name, frames, steps, periods, hv="h", **meta):
+    with open(path, "ab") as f:
+        write_scan(f, name, frames, steps, periods, hv, **meta)
+
+
+class Scan():
+    """A record of a ScanFile: frames, the (N, H, W) memmap view, and its header fields"""
+    def __init__(self, header, frames):
+        self.header = header
+        self.name, self.hv = header["name"], header["hv"]
+        self.steps, self.periods, self.meta = header["steps"], header["periods"], header["meta"]
+        self.frames = frames
+
+    def images(self):
+        """The fringes, a list (frequencies) of (steps, H, W) views"""
+        cuts = np.cumsum([0]+self.steps).tolist()
+        return [self.frames[a:b] for a, b in zip(cuts[:-1], cuts[1:])]
+
+    @property
+    def extras(self):
+        """The frames after the fringes, e.g. the gray image"""
+        return self.frames[sum(self.steps):]
+
+
+class ScanFile():
+    """The records of a container, the file is mapped read-only once"""
+    def __init__(self, path):
+        self.path = Path(path)
+        self.scans, self.index = [], dict()
+        if self.path.stat().st_size == 0:
+            return
+        data = np.memmap(self.path, np.uint8, "r")
+        pos = 0
+        while pos < len(data):
+            assert bytes(data[pos:pos+len(MAGIC)]) == MAGIC, f"no scan record at byte {pos} of {self.path}"
+            pos += len(MAGIC)
+            n = int(data[pos:pos+4].view("<u4")[0])
+            header = json.loads(bytes(data[pos+4:pos+4+n]))
+            pos += 4+n
+            pos += -pos % ALIGN
+            size = int(np.prod(header["shape"]))
+            self.scans.append(Scan(header, data[pos:pos+size].reshape(header["shape"])))
+            pos += size
+        self.index = {(s.name, s.hv): s for s in self.scans}
+
+    def __len__(self):
+        return len(self.scans)
+
+    def __iter__(self):
+        return iter(self.scans)
+
+    def __getitem__(self, i):
+        return self.scans[i]
+
+    def get(self, name, hv="h"):
+        return self.index[name, hv]
+
+    def names(self, hv="h"):
+        return [s.name for s in self.scans if s.hv == hv]
+
+
+def recorded_scans(root, container=None):
+    """The cases recorded under root by Capture.measure_capture, as {case}{i:02d}h.bmp, or the
+    names of the scans of the container under root"""
+    if container:
+        return ScanFile(Path(root)/container).names("h")
+    names = [p.name for p in Path(root).glob("*h.bmp")]
+    return sorted({n[:-7] for n in names if len(n) > 7 and n[-7:-5].isdigit()})
+
+
+def recording_files(root, case):
+    """The BMP files of the scan case under root, {case}{i:02d}h.bmp for i = 0, 1, ..."""
+    files = []
+    while (Path(root)/f"{case}{len(files):0>2d}h.bmp").exists():
+        files.append(Path(root)/f"{case}{len(files):0>2d}h.bmp")
+    return files
+
+
+def recorded_steps(count, config):
+    """The steps per frequency of a recording of count frames, the fringes and then the gray:
+    config.record_steps if set, else config.steps if they fill it, else the fringes split
+    evenly over the frequencies. Raises ValueError when the count does not match"""
+    F = len(config.steps)
+    if config.record_steps:
+        steps = list(config.record_steps)
+    elif count == sum(config.steps)+1:
+        steps = list(config.steps)
+    else:
+        steps = [(count-1)//F]*F
+    if sum(steps)+1 != count or len(steps) != F:
+        raise ValueError(f"a recording of {count} frames is not {steps} fringes and the gray")
+    return steps
+
+
+def _read_frames(files):
+    frames = np.stack([cv2.imread(str(fn), 0) for fn in files])
+    meta = dict(files=[fn.name for fn in files], mtime=time.ctime(os.path.getmtime(files[0])))
+    return frames, meta
+
+
+def convert_recordings(root, out, config):
+    """Pack the BMP scans under root, {case}{i:02d}h.bmp, into the container out, one record
+    each. The header keeps the recorded steps per frequency, recorded_steps() of the frame
+    count, the frame after them (the gray) is kept as extra"""
+    root = Path(root)
+    with open(out, "ab") as f:
+        for case in recorded_scans(root):
+            files = recording_files(root, case)
+            frames, meta = _read_frames(files)
+            write_scan(f, case, frames, recorded_steps(len(files), config), config.Tc, "h", source=str(root), **meta)
+
+
+def convert_calibration(root, out, config, steps=(4, 4, 4)):
+    """Pack the BMP poses under root, {pose:02d}_{j:02d}{hv}.bmp, into the container out: per
+    pose a "h" record with the gray image (j=sum(steps)) as extra and a "v" record, both named
+    {pose:02d}_"""
+    root = Path(root)
+    with open(out, "ab") as f:
+        for i in range(config.calibra_poses):
+            name = f"{i:0>2d}_"
+            for hv, count in (("h", sum(steps)+1), ("v", sum(steps))):
+                files = [root/f"{name}{j:0>2d}{hv}.bmp" for j in range(count)]
+                if not all(fn.exists() for fn in files):
+                    print(f"skip pose {i}{hv}")
+                    continue
+                frames, meta = _read_frames(files)
+                write_scan(f, name, frames, steps, config.Tc, hv, source=str(root), **meta)
+
+
+if __name__ == '__main__':
+    from config import config
+    cfg = config()
+    kind, root, *out = sys.argv[1:]
+    out = out[0] if out else Path(root)/"scans.scan"
+    {"recordings": convert_recordings, "calibration": convert_calibration}[kind](root, out, cfg)
+    print(f"{len(ScanFile(out))} scans in {out}")